@@ -0,0 +1,509 @@
+import asyncio
+import hashlib
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_response_headers
+from django.utils.http import http_date, quote_etag
+
+from .metrics import observe_cache_page, observe_cache_tier
+from .replica import primary_reads
+
+
+VERSION_KEY = "version:{}"
+# When a resource last changed, in the same milliseconds as new version stamps.
+MODIFIED_KEY = "modified:{}"
+
+BOOKS = "books"
+BOOK = "book:{id}"
+AUTHORS = "authors"
+AUTHOR = "author:{id}"
+
+
+class LocalCache:
+    """Process-wide LRU in front of the shared cache, bounded to ``max_size`` bytes.
+
+    Values are pickled, as LocMemCache does, so every reader gets its own copy
+    and the size is known. Entries expire after the timeout given to ``set``.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        expires, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    self._pop(key)
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+        return {key: pickle.loads(value) for key, value in found.items()}
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, data, timeout):
+        expires = time.monotonic() + timeout
+        data = {
+            key: pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            for key, value in data.items()
+        }
+        with self._lock:
+            for key, value in data.items():
+                if key in self._entries:
+                    self._pop(key)
+                if len(value) > self.max_size:
+                    continue
+                self._entries[key] = (expires, value)
+                self._size += len(value)
+            while self._size > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def set(self, key, value, timeout):
+        self.set_many({key: value}, timeout)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+local_cache = LocalCache(settings.LOCAL_CACHE_MAX_SIZE)
+
+
+def _new_version():
+    # Time based, so an evicted stamp never comes back with an old value.
+    return int(time.time() * 1000)
+
+
+def _stamp_keys(names):
+    return [VERSION_KEY.format(name) for name in names] + [
+        MODIFIED_KEY.format(name) for name in names
+    ]
+
+
+def _split_stamps(stamps, count):
+    # A missing modification time was just filled in with "now", so clients
+    # revalidating against an evicted one get a full response.
+    return stamps[:count], max(stamps[count:], default=0)
+
+
+def _missing(keys, found):
+    return [key for key in dict.fromkeys(keys) if key not in found]
+
+
+def get_stamps(names, seed_many=False):
+    """Version stamps of ``names`` and when the most recent of them changed.
+
+    Stamps are read through ``local_cache`` for LOCAL_CACHE_STAMP_TIMEOUT
+    seconds; that is how long other processes may serve pages from before a
+    change. This process sees its own changes at once, see ``bump_versions``.
+
+    Evicted stamps are seeded with ``cache.add``, so concurrent requests agree
+    on them and build a page once. With ``seed_many`` they are written with
+    one ``set_many`` instead; racing callers may then end up with different
+    stamps, which only duplicates entries such as rows.
+    """
+    keys = _stamp_keys(names)
+    stamps = local_cache.get_many(keys)
+    missing = _missing(keys, stamps)
+    observe_cache_tier("stamp", "local", len(keys) - len(missing), len(missing))
+    if missing:
+        shared = cache.get_many(missing)
+        observe_cache_tier("stamp", "shared", len(shared), len(missing) - len(shared))
+        evicted = _missing(missing, shared)
+        if seed_many and evicted:
+            seeded = dict.fromkeys(evicted, _new_version())
+            cache.set_many(seeded, None)
+            shared.update(seeded)
+        else:
+            for key in evicted:
+                stamp = _new_version()
+                if not cache.add(key, stamp, timeout=None):
+                    stamp = cache.get(key, stamp)
+                shared[key] = stamp
+        local_cache.set_many(shared, settings.LOCAL_CACHE_STAMP_TIMEOUT)
+        stamps.update(shared)
+    return _split_stamps([stamps[key] for key in keys], len(names))
+
+
+async def aget_stamps(names, seed_many=False):
+    keys = _stamp_keys(names)
+    stamps = local_cache.get_many(keys)
+    missing = _missing(keys, stamps)
+    observe_cache_tier("stamp", "local", len(keys) - len(missing), len(missing))
+    if missing:
+        shared = await cache.aget_many(missing)
+        observe_cache_tier("stamp", "shared", len(shared), len(missing) - len(shared))
+        evicted = _missing(missing, shared)
+        if seed_many and evicted:
+            seeded = dict.fromkeys(evicted, _new_version())
+            await cache.aset_many(seeded, None)
+            shared.update(seeded)
+        else:
+            for key in evicted:
+                stamp = _new_version()
+                if not await cache.aadd(key, stamp, timeout=None):
+                    stamp = await cache.aget(key, stamp)
+                shared[key] = stamp
+        local_cache.set_many(shared, settings.LOCAL_CACHE_STAMP_TIMEOUT)
+        stamps.update(shared)
+    return _split_stamps([stamps[key] for key in keys], len(names))
+
+
+def bump_versions(*names, items=()):
+    """Change the version stamps of the collections ``names`` and of ``items``.
+
+    Collection stamps are incremented. Item stamps, e.g. one per book of a
+    bulk update, are all set to one new time based version, so together with
+    the modified stamps they take a single ``set_many``.
+    """
+    stamps = {}
+    for name in set(names):
+        key = VERSION_KEY.format(name)
+        # Seed evicted stamps first: django_bmemcached's incr would create
+        # them at 0 and reuse the versions of pages cached before.
+        stamps[key] = _new_version()
+        if cache.add(key, stamps[key], timeout=None):
+            continue
+        try:
+            stamps[key] = cache.incr(key)
+        except ValueError:
+            cache.set(key, stamps[key], timeout=None)
+    now = _new_version()
+    items = set(items)
+    versions = {VERSION_KEY.format(item): now for item in items}
+    modified = {MODIFIED_KEY.format(name): now for name in set(names) | items}
+    cache.set_many({**versions, **modified}, None)
+    local_cache.set_many(
+        {**stamps, **versions, **modified}, settings.LOCAL_CACHE_STAMP_TIMEOUT
+    )
+
+
+def invalidate_books(*book_ids):
+    bump_versions(BOOKS, items=[BOOK.format(id=book_id) for book_id in book_ids])
+
+
+def invalidate_authors(*author_ids):
+    bump_versions(
+        AUTHORS, items=[AUTHOR.format(id=author_id) for author_id in author_ids]
+    )
+
+
+def _key_prefix(names, versions):
+    return "-".join(f"{name}.{version}" for name, version in zip(names, versions))
+
+
+def _validators(request, key_prefix, modified):
+    """Strong ETag and Last-Modified timestamp of a page, from its stamps.
+
+    The body only depends on the stamps, the URL and the negotiated renderer,
+    so the ETag is known without running the view.
+    """
+    tag = "\n".join(
+        (key_prefix, request.build_absolute_uri(), request.META.get("HTTP_ACCEPT", ""))
+    )
+    return quote_etag(hashlib.md5(tag.encode()).hexdigest()), modified // 1000
+
+
+def _set_validators(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _page_key(namespace, etag):
+    # The ETag already covers the stamps, the URL and the Accept header.
+    return f"{namespace}.{etag[1:-1]}"
+
+
+def _page_ttl(timeout):
+    # Give or take CACHE_PAGE_JITTER, so pages cached together expire apart.
+    jitter = settings.CACHE_PAGE_JITTER
+    return timeout * random.uniform(1 - jitter, 1 + jitter)
+
+
+def _fresh(entry):
+    return entry[0] > time.time()
+
+
+def _local_page(request, key):
+    response = local_cache.get(key)
+    observe_cache_tier("page", "local", response is not None, response is None)
+    if response is not None:
+        observe_cache_page(request, "hit")
+    return response
+
+
+def _page_entry(key, response, timeout):
+    """The shared cache entry and its timeout for a 200 ``response``, or None.
+
+    The page is put in ``local_cache`` for as long as it is fresh. Entries are
+    ``(fresh until, response)`` and outlive their freshness by
+    CACHE_PAGE_STALE_TIMEOUT, during which they are served while a single
+    request rebuilds them.
+    """
+    if response.status_code != 200 or response.streaming:
+        return None
+    ttl = _page_ttl(timeout)
+    local_cache.set(key, response, ttl)
+    return (time.time() + ttl, response), ttl + settings.CACHE_PAGE_STALE_TIMEOUT
+
+
+def _store_page(key, response, timeout, locked):
+    """Cache ``response`` once it is rendered, then release the rebuild lock."""
+
+    def store(response):
+        try:
+            entry = _page_entry(key, response, timeout)
+            if entry is not None:
+                cache.set(key, *entry)
+        finally:
+            if locked:
+                cache.delete(f"{key}.lock")
+
+    if response.status_code == 200:
+        patch_response_headers(response, timeout)
+    if hasattr(response, "add_post_render_callback"):
+        # DRF responses are only rendered after the decorated method returns;
+        # the callback runs at once for rendered ones.
+        response.add_post_render_callback(store)
+    else:
+        store(response)
+
+
+def _build_reads(modified):
+    # A lagging replica may not have the change yet, and a page built from it
+    # would be cached under the new stamps.
+    if time.time() * 1000 - modified < settings.REPLICA_STICKY_SECONDS * 1000:
+        return primary_reads()
+    return nullcontext()
+
+
+def _wait_for_page(key):
+    """Poll for the page another request is building, None if it gave up."""
+    deadline = time.monotonic() + settings.CACHE_PAGE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        found = cache.get_many([key, f"{key}.lock"])
+        if key in found or f"{key}.lock" not in found:
+            return found.get(key)
+    return None
+
+
+async def _await_page(key):
+    deadline = time.monotonic() + settings.CACHE_PAGE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        found = await cache.aget_many([key, f"{key}.lock"])
+        if key in found or f"{key}.lock" not in found:
+            return found.get(key)
+    return None
+
+
+def versioned_cache_page(timeout, *resources):
+    """Page cache keyed by the version stamps of ``resources``, with single-flight
+    rebuilds.
+
+    Resources are version names formatted with the view kwargs, e.g.
+    ``versioned_cache_page(60, BOOK)`` for a view taking ``id``. Bumping any of
+    the stamps makes the cached pages unreachable without touching other keys.
+    The stamps also give 200 responses an ETag and Last-Modified, and
+    ``If-None-Match``/``If-Modified-Since`` requests that still match get a 304
+    before the view or the page cache is consulted. Pages are looked up in
+    ``local_cache`` by ETag before the shared cache.
+
+    Pages stay fresh for ``timeout`` seconds give or take CACHE_PAGE_JITTER.
+    Only the request holding a cache lock runs the view for a missing or
+    expired page: the others serve the expired page, or wait up to
+    CACHE_PAGE_LOCK_TIMEOUT seconds for the new one. Only 200 responses are
+    stored, with the same Expires/Cache-Control headers as ``cache_page``.
+    Pages of resources changed in the last REPLICA_STICKY_SECONDS are built
+    from the primary database.
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            names = [resource.format(**kwargs) for resource in resources]
+            versions, modified = get_stamps(names)
+            key_prefix = _key_prefix(names, versions)
+            etag, last_modified = _validators(request, key_prefix, modified)
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is not None:
+                return _set_validators(response, etag, last_modified)
+            key = _page_key("page", etag)
+            response = _local_page(request, key)
+            if response is not None:
+                return _set_validators(response, etag, last_modified)
+
+            entry = cache.get(key)
+            observe_cache_tier("page", "shared", entry is not None, entry is None)
+            if entry is not None and _fresh(entry):
+                observe_cache_page(request, "hit")
+                local_cache.set(key, entry[1], entry[0] - time.time())
+                return _set_validators(entry[1], etag, last_modified)
+
+            locked = cache.add(f"{key}.lock", 1, settings.CACHE_PAGE_LOCK_TIMEOUT)
+            if not locked:
+                if entry is not None:
+                    observe_cache_page(request, "stale")
+                    return _set_validators(entry[1], etag, last_modified)
+                entry = _wait_for_page(key)
+                if entry is not None:
+                    observe_cache_page(request, "hit")
+                    return _set_validators(entry[1], etag, last_modified)
+                # The request holding the lock failed or gave up.
+
+            observe_cache_page(request, "miss")
+            try:
+                with _build_reads(modified):
+                    response = view_func(request, *args, **kwargs)
+            except BaseException:
+                # E.g. NotFound for a bad cursor; the next request retries.
+                if locked:
+                    cache.delete(f"{key}.lock")
+                raise
+            _set_validators(response, etag, last_modified)
+            _store_page(key, response, timeout, locked)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def async_versioned_cache_page(timeout, *resources):
+    """``versioned_cache_page`` for async views, through the async cache API."""
+
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            names = [resource.format(**kwargs) for resource in resources]
+            versions, modified = await aget_stamps(names)
+            key_prefix = _key_prefix(names, versions)
+            etag, last_modified = _validators(request, key_prefix, modified)
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is not None:
+                return _set_validators(response, etag, last_modified)
+            key = _page_key("async_page", etag)
+            response = _local_page(request, key)
+            if response is not None:
+                return _set_validators(response, etag, last_modified)
+
+            entry = await cache.aget(key)
+            observe_cache_tier("page", "shared", entry is not None, entry is None)
+            if entry is not None and _fresh(entry):
+                observe_cache_page(request, "hit")
+                local_cache.set(key, entry[1], entry[0] - time.time())
+                return _set_validators(entry[1], etag, last_modified)
+
+            lock_timeout = settings.CACHE_PAGE_LOCK_TIMEOUT
+            locked = await cache.aadd(f"{key}.lock", 1, lock_timeout)
+            if not locked:
+                if entry is not None:
+                    observe_cache_page(request, "stale")
+                    return _set_validators(entry[1], etag, last_modified)
+                entry = await _await_page(key)
+                if entry is not None:
+                    observe_cache_page(request, "hit")
+                    return _set_validators(entry[1], etag, last_modified)
+
+            observe_cache_page(request, "miss")
+            try:
+                with _build_reads(modified):
+                    response = await view_func(request, *args, **kwargs)
+            except BaseException:
+                # E.g. NotFound for a bad cursor; the next request retries.
+                if locked:
+                    await cache.adelete(f"{key}.lock")
+                raise
+            _set_validators(response, etag, last_modified)
+            try:
+                if response.status_code == 200:
+                    patch_response_headers(response, timeout)
+                entry = _page_entry(key, response, timeout)
+                if entry is not None:
+                    await cache.aset(key, *entry)
+            finally:
+                if locked:
+                    await cache.adelete(f"{key}.lock")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _row_keys(resource, ids, versions):
+    return {
+        id: f"row.{resource.format(id=id)}.{version}"
+        for id, version in zip(ids, versions)
+    }
+
+
+def cached_rows(resource, ids, fetch, timeout):
+    """``{id: row}`` for ``ids``, cached per id under its ``resource`` stamp.
+
+    One stamp lookup and one ``get_many`` serve the cached rows; the rest
+    come from a single ``fetch(missing ids)`` returning ``{id: row}``. Ids it
+    leaves out are missing from the result too. Bumping an id's stamp, e.g.
+    through ``invalidate_books``, makes its cached row unreachable.
+    """
+    versions, modified = get_stamps(
+        [resource.format(id=id) for id in ids], seed_many=True
+    )
+    keys = _row_keys(resource, ids, versions)
+    rows = cache.get_many(keys.values())
+    observe_cache_tier("row", "shared", len(rows), len(keys) - len(rows))
+    rows = {id: rows[key] for id, key in keys.items() if key in rows}
+    missing = [id for id in ids if id not in rows]
+    if missing:
+        with _build_reads(modified):
+            fetched = fetch(missing)
+        cache.set_many({keys[id]: row for id, row in fetched.items()}, timeout)
+        rows.update(fetched)
+    return rows
+
+
+async def acached_rows(resource, ids, fetch, timeout):
+    """``cached_rows`` through the async cache API, awaiting ``fetch``."""
+    versions, modified = await aget_stamps(
+        [resource.format(id=id) for id in ids], seed_many=True
+    )
+    keys = _row_keys(resource, ids, versions)
+    rows = await cache.aget_many(keys.values())
+    observe_cache_tier("row", "shared", len(rows), len(keys) - len(rows))
+    rows = {id: rows[key] for id, key in keys.items() if key in rows}
+    missing = [id for id in ids if id not in rows]
+    if missing:
+        with _build_reads(modified):
+            fetched = await fetch(missing)
+        await cache.aset_many({keys[id]: row for id, row in fetched.items()}, timeout)
+        rows.update(fetched)
+    return rows
@@ -0,0 +1,122 @@
+import csv
+import io
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from rest_framework import serializers
+
+from .models import OrderItem
+
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+BOOK_FIELDS = {
+    "id": "id",
+    "title": "title",
+    "genre": "genre",
+    "author": "author__name",
+    "price": "price",
+    "quantity": "quantity",
+    "publication_date": "publication_date",
+    "updated_at": "updated_at",
+}
+
+ORDER_FIELDS = {
+    "id": "id",
+    "total_price": "total_price",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+    "invoice_id": "invoice_id",
+    "status": "status",
+}
+
+ORDER_COLUMNS = [*ORDER_FIELDS, "books"]
+
+_datetime = serializers.DateTimeField()
+_date = serializers.DateField()
+
+
+def _format_row(row, formatters):
+    return [
+        value if value is None or formatter is None else formatter(value)
+        for value, formatter in zip(row, formatters)
+    ]
+
+
+def book_rows(queryset, chunk_size):
+    """Book rows in watermark order, fetched through a server-side cursor."""
+    formatters = [None] * 6 + [_date.to_representation, _datetime.to_representation]
+    rows = (
+        queryset.order_by("updated_at", "id")
+        .values_list(*BOOK_FIELDS.values())
+        .iterator(chunk_size=chunk_size)
+    )
+    for row in rows:
+        yield _format_row(row, formatters)
+
+
+def order_rows(queryset, chunk_size):
+    """Order rows in watermark order with their book ids, one query per chunk."""
+    formatters = [None, None, _datetime.to_representation]
+    formatters += [_datetime.to_representation, None, None]
+    rows = (
+        queryset.order_by("updated_at", "id")
+        .values_list(*ORDER_FIELDS.values())
+        .iterator(chunk_size=chunk_size)
+    )
+    for chunk in _batched(rows, chunk_size):
+        books = {}
+        items = OrderItem.objects.filter(order_id__in=[row[0] for row in chunk])
+        for order_id, book_id in items.order_by("id").values_list(
+            "order_id", "book_id"
+        ):
+            books.setdefault(order_id, []).append(book_id)
+        for row in chunk:
+            yield _format_row(row, formatters) + [books.get(row[0], [])]
+
+
+def encode(rows, fmt, fields, chunk_size):
+    """Serialize ``rows`` as NDJSON or CSV, ``chunk_size`` rows per string."""
+    if fmt == "csv":
+        yield _csv_lines([fields])
+        for chunk in _batched(rows, chunk_size):
+            yield _csv_lines(chunk)
+        return
+
+    for chunk in _batched(rows, chunk_size):
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n"
+            for row in chunk
+        )
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [
+            ";".join(map(str, value)) if isinstance(value, list) else value
+            for value in row
+        ]
+        for row in rows
+    )
+    return buffer.getvalue()
+
+
+def _batched(rows, size):
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+
+async def aiterate(iterator):
+    """Hand a sync iterator to ASGI chunk by chunk.
+
+    Django 4.2 reads a sync ``streaming_content`` into a list before sending it
+    over ASGI, which would hold the whole export in memory.
+    """
+    iterator = iter(iterator)
+    next_chunk = sync_to_async(next)
+    done = object()
+    while (chunk := await next_chunk(iterator, done)) is not done:
+        yield chunk
@@ -0,0 +1,13 @@
+import django_filters
+
+from .models import Order
+
+
+class OrderFilter(django_filters.FilterSet):
+    """``?status=`` plus ``?created_at_after=`` / ``?created_at_before=``."""
+
+    created_at = django_filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = Order
+        fields = ["status", "created_at"]
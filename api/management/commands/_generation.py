@@ -0,0 +1,60 @@
+import itertools
+import multiprocessing
+import random
+from contextlib import contextmanager
+
+from django.core.management.base import CommandError
+from django.db import connection, connections
+
+
+def zipf_cum_weights(n, s=1.1):
+    """Cumulative Zipf weights for ``random.choices(..., cum_weights=...)``."""
+    return list(itertools.accumulate(1 / rank**s for rank in range(1, n + 1)))
+
+
+def chunks(total, batch_size, seed):
+    """Split ``total`` rows into ``(size, chunk seed)`` pairs.
+
+    Every chunk gets its own seed drawn from ``seed``, so the output does not
+    depend on how the chunks are spread across workers.
+    """
+    rng = random.Random(seed)
+    result = []
+    while total > 0:
+        size = min(total, batch_size)
+        result.append((size, rng.getrandbits(64)))
+        total -= size
+    return result
+
+
+def check_workers(workers):
+    if workers < 1:
+        raise CommandError("--workers should be at least 1")
+    if workers > 1 and connection.vendor == "sqlite":
+        raise CommandError("--workers > 1 needs a database with concurrent writers")
+
+
+def run_chunks(worker, chunk_list, workers, initializer, initargs=()):
+    """Yield ``worker(chunk)`` results, in a process pool when ``workers > 1``."""
+    if workers == 1:
+        initializer(*initargs)
+        yield from map(worker, chunk_list)
+        return
+
+    # Forked workers inherit the configured Django state but must not share the
+    # parent's database connection.
+    connections.close_all()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, initializer, initargs) as pool:
+        yield from pool.imap_unordered(worker, chunk_list)
+
+
+@contextmanager
+def disable_auto_now_add(model, field_name):
+    """Let ``bulk_create`` keep explicit values of an ``auto_now_add`` field."""
+    field = model._meta.get_field(field_name)
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
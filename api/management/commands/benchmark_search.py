@@ -0,0 +1,92 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from api.models import Author, Book
+from api.search import LikeSearchBackend, get_search_backend
+
+
+QUERIES = [
+    {"search": "vol"},
+    {"search": "market"},
+    {"title": "ight"},
+    {"author": "word"},
+    {"genre": "fant", "search": "the"},
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the catalog up to each size and compare search latency of the "
+        "icontains filters with the configured search backend. Run it against "
+        "a scratch database; created rows are removed unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("sizes", nargs="*", type=int, default=[100_000, 1_000_000])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keep", action="store_true")
+
+    def seed(self, author, count, batch_size, rng):
+        words = LoremProvider.word_list
+        genres = ["Fantasy", "Mystery", "Romance", "Thriller", "Biography"]
+        while count > 0:
+            size = min(count, batch_size)
+            Book.objects.bulk_create(
+                Book(
+                    title=" ".join(rng.choices(words, k=4)).capitalize(),
+                    author=author,
+                    genre=rng.choice(genres),
+                )
+                for _ in range(size)
+            )
+            count -= size
+
+    def measure(self, backend, filters, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            queryset = backend.filter(Book.objects.select_related("author"), **filters)
+            queryset.count()
+            list(queryset[:15])
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def handle(self, *args, sizes, repeat, batch_size, seed, keep, **options):
+        rng = random.Random(seed)
+        author = Author.objects.create(name="Benchmark Wordsworth")
+        backends = [LikeSearchBackend(), get_search_backend()]
+
+        try:
+            for size in sorted(sizes):
+                missing = size - Book.objects.count()
+                if missing > 0:
+                    started = time.perf_counter()
+                    self.seed(author, missing, batch_size, rng)
+                    self.stdout.write(
+                        "Seeded %s books in %.1fs"
+                        % (missing, time.perf_counter() - started)
+                    )
+
+                self.stdout.write(f"\n{size} books, median of {repeat} runs (ms)")
+                for filters in QUERIES:
+                    timings = [
+                        self.measure(backend, filters, repeat) for backend in backends
+                    ]
+                    self.stdout.write(
+                        "  %-40s" % str(filters)
+                        + "".join(
+                            "  %s=%.1f" % (type(backend).__name__, timing)
+                            for backend, timing in zip(backends, timings)
+                        )
+                    )
+        finally:
+            if not keep:
+                author.delete()
+
+        self.stdout.write(self.style.SUCCESS("Search benchmark finished"))
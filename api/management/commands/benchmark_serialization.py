@@ -0,0 +1,55 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Book
+from api.renderers import ORJSONRenderer
+from api.serializers import BOOK_VALUES, BookSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rows per second of a /books page built with BookSerializer and "
+        "JSONRenderer against the values() fast path with ORJSONRenderer. The "
+        "database should already hold at least --limit books (see generate_books)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def serializer_page(self, limit):
+        books = Book.objects.select_related("author").order_by("id")[:limit]
+        return JSONRenderer().render(BookSerializer(books, many=True).data)
+
+    def values_page(self, limit):
+        rows = BOOK_VALUES.values(Book.objects.order_by("id"))[:limit]
+        return ORJSONRenderer().render(BOOK_VALUES.data(rows))
+
+    def measure(self, build, limit, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            build(limit)
+            timings.append(time.perf_counter() - started)
+        return limit / statistics.median(timings)
+
+    def handle(self, *args, limit, repeat, **options):
+        limit = min(limit, Book.objects.count())
+        if not limit:
+            raise CommandError("no books, run generate_books first")
+        if self.serializer_page(limit) != self.values_page(limit):
+            raise CommandError("the fast path output differs from BookSerializer")
+
+        self.stdout.write(f"{limit} books per page, median of {repeat} runs")
+        before = self.measure(self.serializer_page, limit, repeat)
+        after = self.measure(self.values_page, limit, repeat)
+        self.stdout.write(
+            "  %-40s %10.0f rows/s" % ("BookSerializer + JSONRenderer", before)
+        )
+        self.stdout.write(
+            "  %-40s %10.0f rows/s" % ("values() + ORJSONRenderer", after)
+        )
+        self.stdout.write(self.style.SUCCESS("%.1fx faster" % (after / before)))
@@ -1,13 +1,15 @@
 import random
+import time
 from datetime import datetime, timedelta
 
 from django.core.management.base import BaseCommand
 from faker import Faker
 
 from api.models import Book, Author
+from ._generation import check_workers, chunks, run_chunks, zipf_cum_weights
 
 
-def get_random_genre():
+def get_random_genre(rng=random):
     genre_list = [
         "Fiction",
         "Mystery",
@@ -20,40 +22,104 @@ def get_random_genre():
         "Biography",
         "Self-Help",
     ]
-    return random.choice(genre_list)
+    return rng.choice(genre_list)
 
 
-def generate_random_date():
+def generate_random_date(rng=random):
     start_date = datetime(1900, 1, 1)
     end_date = datetime(2022, 12, 31)
     days_difference = (end_date - start_date).days
-    random_days = random.randint(0, days_difference)
+    random_days = rng.randint(0, days_difference)
     random_date = start_date + timedelta(days=random_days)
     return random_date.date()
 
 
+def generate_authors(count, faker, batch_size):
+    # Author names are unique ignoring case, including the existing ones.
+    taken = {name.upper() for name in Author.objects.values_list("name", flat=True)}
+    names = []
+    while len(names) < count:
+        name = f"{faker.first_name()} {faker.last_name()}"
+        while name.upper() in taken:
+            name = f"{name} {len(taken)}"
+        taken.add(name.upper())
+        names.append(name)
+    authors = Author.objects.bulk_create(
+        (Author(name=name) for name in names), batch_size=batch_size
+    )
+    return [author.id for author in authors]
+
+
+_author_ids = None
+_author_weights = None
+
+
+def init_worker(author_ids, author_weights):
+    global _author_ids, _author_weights
+    _author_ids = author_ids
+    _author_weights = author_weights
+
+
+def create_books(chunk):
+    size, seed = chunk
+    rng = random.Random(seed)
+    faker = Faker()
+    faker.seed_instance(seed)
+    # Popular authors (low Zipf rank) get most of the books.
+    author_ids = rng.choices(_author_ids, cum_weights=_author_weights, k=size)
+    Book.objects.bulk_create(
+        Book(
+            title=faker.sentence().replace(".", ""),
+            author_id=author_id,
+            genre=get_random_genre(rng),
+            price=rng.randint(10000, 50000),
+            quantity=rng.randint(10, 100),
+            publication_date=generate_random_date(rng),
+        )
+        for author_id in author_ids
+    )
+    return size
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("books_count", nargs="?", type=int, default=10)
+        parser.add_argument(
+            "--authors",
+            type=int,
+            help="size of the author pool (default: one author per 10 books)",
+        )
+        parser.add_argument("--seed", type=int)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--workers", type=int, default=1)
 
-    def handle(self, *args, books_count, **options):
+    def handle(self, *args, books_count, authors, seed, batch_size, workers, **options):
+        check_workers(workers)
+        started = time.perf_counter()
+        rng = random.Random(seed)
         faker = Faker()
+        faker.seed_instance(rng.getrandbits(64))
 
-        books = []
-        for _ in range(books_count):
-            author = Author(name=f"{faker.first_name()} {faker.last_name()}")
-            author.save()
-            book = Book(
-                title=faker.sentence().replace(".", ""),
-                author_id=author.id,
-                genre=get_random_genre(),
-                price=faker.random_int(min=10000, max=50000),
-                quantity=faker.random_int(min=10, max=100),
-                publication_date=generate_random_date(),
-            )
-            books.append(book)
-        Book.objects.bulk_create(books)
+        authors_count = authors or max(1, books_count // 10)
+        author_ids = generate_authors(authors_count, faker, batch_size)
+        rng.shuffle(author_ids)
+        author_weights = zipf_cum_weights(len(author_ids))
+
+        created = 0
+        for size in run_chunks(
+            create_books,
+            chunks(books_count, batch_size, rng.getrandbits(64)),
+            workers,
+            init_worker,
+            (author_ids, author_weights),
+        ):
+            created += size
+            self.stdout.write(f"{created}/{books_count} books", ending="\r")
 
+        elapsed = time.perf_counter() - started
         self.stdout.write(
-            self.style.SUCCESS("Successfully created %s books" % books_count)
+            self.style.SUCCESS(
+                "Successfully created %s books by %s authors in %.1fs (%d rows/s)"
+                % (books_count, authors_count, elapsed, books_count / elapsed)
+            )
         )
@@ -1,45 +1,127 @@
 import random
+import string
+import time
 from datetime import datetime, timedelta, timezone
 
-from django.core.management.base import BaseCommand
-from faker import Faker
+from django.core.management.base import BaseCommand, CommandError
 
-from api.models import Order
+from api.models import Book, Order, OrderItem
+from ._generation import (
+    check_workers,
+    chunks,
+    disable_auto_now_add,
+    run_chunks,
+    zipf_cum_weights,
+)
 
 
-def generate_random_date():
+STATUSES = ["created", "processing", "success", "failure", "expired"]
+STATUS_WEIGHTS = [10, 5, 70, 10, 5]
+
+
+def generate_random_date(rng=random):
     start_date = datetime(2023, 1, 1)
     end_date = datetime(2023, 7, 31)
     days_difference = (end_date - start_date).days
-    random_days = random.randint(0, days_difference)
+    random_days = rng.randint(0, days_difference)
     random_date = start_date + timedelta(days=random_days)
     random_datetime = random_date.replace(
-        hour=random.randint(0, 23),
-        minute=random.randint(0, 59),
-        second=random.randint(0, 59),
-        microsecond=random.randint(0, 999999),
+        hour=rng.randint(0, 23),
+        minute=rng.randint(0, 59),
+        second=rng.randint(0, 59),
+        microsecond=rng.randint(0, 999999),
         tzinfo=timezone.utc,
     )
     return random_datetime
 
 
+def generate_invoice_id(rng=random):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=20))
+
+
+_books = None
+_book_weights = None
+_max_items = None
+
+
+def init_worker(books, book_weights, max_items):
+    global _books, _book_weights, _max_items
+    _books = books
+    _book_weights = book_weights
+    _max_items = max_items
+
+
+def create_orders(chunk):
+    size, seed = chunk
+    rng = random.Random(seed)
+    orders = []
+    order_books = []
+    for _ in range(size):
+        # Popular books (low Zipf rank) end up in most of the orders.
+        items_count = rng.randint(1, min(_max_items, len(_books)))
+        items = {}
+        while len(items) < items_count:
+            book_id, price = rng.choices(_books, cum_weights=_book_weights)[0]
+            items[book_id] = (price, rng.randint(1, 3))
+        orders.append(
+            Order(
+                total_price=sum(price * qty for price, qty in items.values()),
+                created_at=generate_random_date(rng),
+                invoice_id=generate_invoice_id(rng),
+                status=rng.choices(STATUSES, weights=STATUS_WEIGHTS)[0],
+            )
+        )
+        order_books.append(items)
+
+    orders = Order.objects.bulk_create(orders)
+    OrderItem.objects.bulk_create(
+        OrderItem(order_id=order.id, book_id=book_id, quantity=qty, price=price)
+        for order, items in zip(orders, order_books)
+        for book_id, (price, qty) in items.items()
+    )
+    return size, sum(len(items) for items in order_books)
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("orders_count", nargs="?", type=int, default=10)
+        parser.add_argument("--max-items", type=int, default=5)
+        parser.add_argument("--seed", type=int)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--workers", type=int, default=1)
 
-    def handle(self, *args, orders_count, **options):
-        faker = Faker()
+    def handle(
+        self, *args, orders_count, max_items, seed, batch_size, workers, **options
+    ):
+        check_workers(workers)
+        if max_items < 1:
+            raise CommandError("--max-items should be at least 1")
+        books = list(Book.objects.order_by("id").values_list("id", "price"))
+        if not books:
+            raise CommandError("no books yet, run generate_books first")
 
-        for _ in range(orders_count):
-            order = Order(
-                total_price=faker.random_int(min=10000, max=100000),
-                invoice_id="23072226PYknLaw6C1tj",
-                status="created",
-            )
-            order.save()
-            order.created_at = generate_random_date()
-            order.save()
+        started = time.perf_counter()
+        rng = random.Random(seed)
+        rng.shuffle(books)
+        book_weights = zipf_cum_weights(len(books))
 
+        created = items = 0
+        with disable_auto_now_add(Order, "created_at"):
+            for orders_done, items_done in run_chunks(
+                create_orders,
+                chunks(orders_count, batch_size, rng.getrandbits(64)),
+                workers,
+                init_worker,
+                (books, book_weights, max_items),
+            ):
+                created += orders_done
+                items += items_done
+                self.stdout.write(f"{created}/{orders_count} orders", ending="\r")
+
+        elapsed = time.perf_counter() - started
         self.stdout.write(
-            self.style.SUCCESS("Successfully created %s orders" % orders_count)
+            self.style.SUCCESS(
+                "Successfully created %s orders with %s items in %.1fs (%d rows/s)"
+                % (orders_count, items, elapsed, (orders_count + items) / elapsed)
+            )
         )
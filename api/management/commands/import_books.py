@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import FORMATS, BookImporter
+
+
+class Command(BaseCommand):
+    help = "Stream books from a CSV or NDJSON file (or - for stdin) into the catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=FORMATS)
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, path, format, batch_size, **options):
+        if format is None:
+            if path.endswith(".csv"):
+                format = "csv"
+            elif path.endswith((".ndjson", ".jsonl")):
+                format = "ndjson"
+            else:
+                raise CommandError("pass --format csv or --format ndjson")
+
+        importer = BookImporter(batch_size=batch_size)
+        if path == "-":
+            result = importer.run(sys.stdin, format)
+        else:
+            with open(path, newline="", encoding="utf-8") as f:
+                result = importer.run(f, format)
+
+        for error in result["errors"]:
+            self.stderr.write("line %(line)s: %(error)s" % error)
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Imported %(created)s books, rejected %(rejected)s lines "
+                "in %(seconds)ss (%(rows_per_second)s rows/s)" % result
+            )
+        )
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.mono import process_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the Monobank callbacks queued by /monobank/callback to their "
+        "orders. Drains the inbox and exits, or keeps polling it with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="seconds between polls of an empty inbox (default: exit)",
+        )
+
+    def handle(self, *args, batch_size, interval, **options):
+        if batch_size < 1:
+            raise CommandError("--batch-size should be at least 1")
+
+        while True:
+            started = time.perf_counter()
+            events = orders = 0
+            for batch_events, batch_orders in process_events(batch_size):
+                events += batch_events
+                orders += batch_orders
+            if events or not interval:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        "Processed %s events, updated %s orders in %.1fs"
+                        % (events, orders, time.perf_counter() - started)
+                    )
+                )
+            if not interval:
+                return
+            time.sleep(interval)
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the sales rollups behind /stats from all paid orders. "
+        "Callbacks processed while it runs may be counted twice, so run it "
+        "when few orders are being paid."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, batch_size, **options):
+        if batch_size < 1:
+            raise CommandError("--batch-size should be at least 1")
+
+        started = time.perf_counter()
+        done = 0
+        for done in rebuild(batch_size):
+            self.stdout.write(f"{done} orders", ending="\r")
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Rebuilt rollups from %s paid orders in %.1fs"
+                % (done, time.perf_counter() - started)
+            )
+        )
@@ -0,0 +1,176 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker writes
+# its samples to mmap'd files in that directory and /metrics merges them.
+
+REQUEST_LATENCY = Histogram(
+    "bookstore_request_duration_seconds",
+    "Request latency by view, method and status",
+    ["view", "method", "status"],
+)
+DB_QUERIES = Histogram(
+    "bookstore_db_queries_per_request",
+    "Database queries run by one request",
+    ["view"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+DB_TIME = Histogram(
+    "bookstore_db_duration_seconds_per_request",
+    "Time one request spent in database queries",
+    ["view"],
+)
+CACHE_PAGE = Counter(
+    "bookstore_cache_page_total",
+    "Page cache lookups by view and result (hit, stale or miss)",
+    ["view", "result"],
+)
+CACHE_TIER = Counter(
+    "bookstore_cache_tier_total",
+    "Two-tier cache lookups by kind (page, stamp or row), tier (local or "
+    "shared) and result",
+    ["kind", "tier", "result"],
+)
+OUTBOUND_LATENCY = Histogram(
+    "bookstore_outbound_request_duration_seconds",
+    "Outbound HTTP latency by upstream and status (error when no response)",
+    ["upstream", "status"],
+)
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match else "unmatched"
+
+
+def observe_cache_page(request, result):
+    CACHE_PAGE.labels(view_name(request), result).inc()
+
+
+def observe_cache_tier(kind, tier, hits, misses):
+    if hits:
+        CACHE_TIER.labels(kind, tier, "hit").inc(hits)
+    if misses:
+        CACHE_TIER.labels(kind, tier, "miss").inc(misses)
+
+
+def observe_outbound(upstream, status, seconds):
+    OUTBOUND_LATENCY.labels(upstream, str(status)).observe(seconds)
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+_timer = ContextVar("query_timer", default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    timer = _timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def install_query_timer(connection, **kwargs):
+    # First in the list so ``execute_wrapper`` blocks never pop it.
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _time_query)
+
+
+connection_created.connect(install_query_timer)
+
+
+@contextmanager
+def timed_queries(timer):
+    """Count the queries run in this context into ``timer``.
+
+    Connections are per thread, so every connection times its queries and
+    the timer follows the context into ``sync_to_async`` threads, where
+    ASGI requests run their sync middleware and views.
+    """
+    for connection in connections.all(initialized_only=True):
+        install_query_timer(connection)
+    token = _timer.set(timer)
+    try:
+        yield
+    finally:
+        _timer.reset(token)
+
+
+class MetricsMiddleware:
+    """Records latency, query count and query time for every request.
+
+    Works in both sync and async stacks so it does not push ASGI requests onto
+    a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with timed_queries(timer):
+            response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with timed_queries(timer):
+            response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    def observe(self, request, response, elapsed, timer):
+        view = view_name(request)
+        REQUEST_LATENCY.labels(view, request.method, str(response.status_code)).observe(
+            elapsed
+        )
+        DB_QUERIES.labels(view).observe(timer.count)
+        DB_TIME.labels(view).observe(timer.duration)
+
+
+def metrics(request):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
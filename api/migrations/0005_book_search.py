@@ -0,0 +1,60 @@
+from django.db import migrations
+
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS book_title_trgm_idx "
+    "ON api_book USING gin (UPPER(title::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS book_genre_trgm_idx "
+    "ON api_book USING gin (UPPER(genre::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS author_name_trgm_idx "
+    "ON api_author USING gin (UPPER(name::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS book_title_tsv_idx "
+    "ON api_book USING gin (to_tsvector('simple'::regconfig, COALESCE(title, '')))",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS book_title_trgm_idx",
+    "DROP INDEX IF EXISTS book_genre_trgm_idx",
+    "DROP INDEX IF EXISTS author_name_trgm_idx",
+    "DROP INDEX IF EXISTS book_title_tsv_idx",
+]
+
+# The sync triggers are (re)installed by api.search.install_sqlite_triggers on
+# post_migrate, since SQLite drops them whenever a migration remakes the table.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE api_book_fts "
+    "USING fts5(title, author, genre, tokenize='trigram')",
+    "INSERT INTO api_book_fts(rowid, title, author, genre) "
+    "SELECT api_book.id, title, name, genre "
+    "FROM api_book JOIN api_author ON api_author.id = api_book.author_id",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS api_book_fts_insert",
+    "DROP TRIGGER IF EXISTS api_book_fts_update",
+    "DROP TRIGGER IF EXISTS api_book_fts_delete",
+    "DROP TRIGGER IF EXISTS api_author_fts_update",
+    "DROP TABLE IF EXISTS api_book_fts",
+]
+
+
+def run_for_vendor(statements):
+    def inner(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+
+    return inner
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0004_book_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({"postgresql": POSTGRES_FORWARD, "sqlite": SQLITE_FORWARD}),
+            run_for_vendor({"postgresql": POSTGRES_REVERSE, "sqlite": SQLITE_REVERSE}),
+        ),
+    ]
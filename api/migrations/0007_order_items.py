@@ -0,0 +1,36 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_item_prices(apps, schema_editor):
+    # Best effort for old orders: the price the book has now.
+    Book = apps.get_model("api", "Book")
+    OrderItem = apps.get_model("api", "OrderItem")
+    OrderItem.objects.filter(price=None).update(
+        price=Subquery(Book.objects.filter(id=OuterRef("book_id")).values("price"))
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0006_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="orderitem",
+            name="price",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_item_prices, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(fields=["status", "id"], name="order_status_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["created_at", "id"], name="order_created_at_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0007_order_items"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SalesRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("dimension", models.CharField(max_length=16)),
+                ("period", models.CharField(max_length=8)),
+                ("key", models.CharField(blank=True, max_length=255)),
+                ("day", models.DateField()),
+                ("revenue", models.BigIntegerField(default=0)),
+                ("units", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=[
+                            "dimension",
+                            "period",
+                            "day",
+                            "key",
+                            "revenue",
+                            "units",
+                        ],
+                        name="salesrollup_stats_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="salesrollup",
+            constraint=models.UniqueConstraint(
+                fields=("dimension", "period", "day", "key"), name="salesrollup_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations, models
+from django.db.models import Count, Min, Q
+import django.db.models.functions.text
+from django.db.models.functions import Upper
+
+
+def merge_duplicate_authors(apps, schema_editor):
+    # Normalize whitespace the way Author lookups do, then keep the oldest of
+    # the authors whose names only differ in case and move their books to it.
+    Author = apps.get_model("api", "Author")
+    Book = apps.get_model("api", "Book")
+    untidy = Author.objects.filter(
+        Q(name__startswith=" ")
+        | Q(name__endswith=" ")
+        | Q(name__contains="  ")
+        | Q(name__contains="\t")
+        | Q(name__contains="\n")
+    )
+    for author in untidy.iterator():
+        author.name = " ".join(author.name.split())
+        author.save(update_fields=["name"])
+
+    duplicates = (
+        Author.objects.annotate(name_upper=Upper("name"))
+        .values("name_upper")
+        .annotate(count=Count("id"), keep=Min("id"))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for group in duplicates:
+        ids = list(
+            Author.objects.annotate(name_upper=Upper("name"))
+            .filter(name_upper=group["name_upper"])
+            .exclude(id=group["keep"])
+            .values_list("id", flat=True)
+        )
+        Book.objects.filter(author_id__in=ids).update(author_id=group["keep"])
+        Author.objects.filter(id__in=ids).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0008_salesrollup"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="order",
+            name="invoice_id",
+            field=models.CharField(db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_authors, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="author",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Upper("name"),
+                name="author_name_upper_unique",
+            ),
+        ),
+    ]
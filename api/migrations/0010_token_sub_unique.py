@@ -0,0 +1,30 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def drop_duplicate_tokens(apps, schema_editor):
+    # Keep the newest row of every subject that signed up more than once.
+    Token = apps.get_model("api", "Token")
+    duplicates = (
+        Token.objects.values("sub")
+        .annotate(count=Count("id"), keep=Max("id"))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for group in duplicates:
+        Token.objects.filter(sub=group["sub"]).exclude(id=group["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0009_author_name_unique"),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="token",
+            name="sub",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0010_token_sub_unique"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonoEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("invoice_id", models.CharField(max_length=255)),
+                ("modified_date", models.DateTimeField()),
+                ("reference", models.CharField(max_length=255)),
+                ("status", models.CharField(max_length=255)),
+                ("payload", models.JSONField()),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+                ("processed_at", models.DateTimeField(null=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["processed_at", "id"], name="monoevent_pending_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="monoevent",
+            constraint=models.UniqueConstraint(
+                fields=("invoice_id", "modified_date"), name="monoevent_unique"
+            ),
+        ),
+    ]
@@ -1,19 +1,62 @@
 from datetime import date
 
-import requests
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Upper
+
+from .outbound import get_client
 
 
 class Token(models.Model):
-    sub = models.CharField(max_length=255)
+    sub = models.CharField(max_length=255, unique=True)
     token = models.CharField(max_length=512)
     created = models.DateTimeField(auto_now_add=True, blank=True)
 
 
+def normalize_author_name(name):
+    """Collapse runs of whitespace; case is kept but ignored by lookups."""
+    return " ".join(name.split())
+
+
+class AuthorQuerySet(models.QuerySet):
+    def by_name(self, name):
+        """Authors named ``name``, ignoring case and extra whitespace.
+
+        Compares ``UPPER(name)`` so the lookup uses ``author_name_upper_unique``.
+        """
+        return self.alias(name_upper=Upper("name")).filter(
+            name_upper=Upper(Value(normalize_author_name(name)))
+        )
+
+    def by_names(self, names):
+        """Authors named like any of ``names``, see ``by_name``."""
+        return self.alias(name_upper=Upper("name")).filter(
+            name_upper__in=[Upper(Value(normalize_author_name(name))) for name in names]
+        )
+
+    def get_or_create_by_name(self, name):
+        author = self.by_name(name).first()
+        if author is not None:
+            return author, False
+        try:
+            with transaction.atomic():
+                return self.create(name=normalize_author_name(name)), True
+        except IntegrityError:
+            # Created by a concurrent request since the lookup above.
+            return self.by_name(name).get(), False
+
+
 class Author(models.Model):
     name = models.CharField(max_length=255)
 
+    objects = AuthorQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Upper("name"), name="author_name_upper_unique"),
+        ]
+
 
 class Book(models.Model):
     title = models.CharField(max_length=255)
@@ -22,20 +65,99 @@ class Book(models.Model):
     price = models.PositiveIntegerField(default=1)
     quantity = models.IntegerField(default=1)
     publication_date = models.DateField(default=date.today)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["price", "id"], name="book_price_id_idx"),
+            models.Index(
+                fields=["publication_date", "id"], name="book_pub_date_id_idx"
+            ),
+            models.Index(fields=["title", "id"], name="book_title_id_idx"),
+            models.Index(fields=["updated_at", "id"], name="book_updated_at_id_idx"),
+        ]
 
 
 class Order(models.Model):
     books = models.ManyToManyField(Book, through="OrderItem")
     total_price = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
-    invoice_id = models.CharField(max_length=255, null=True)
+    invoice_id = models.CharField(max_length=255, null=True, db_index=True)
     status = models.CharField(max_length=255, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["updated_at", "id"], name="order_updated_at_id_idx"),
+            models.Index(fields=["status", "id"], name="order_status_id_idx"),
+            models.Index(fields=["created_at", "id"], name="order_created_at_id_idx"),
+        ]
 
 
 class OrderItem(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    # Unit price when the order was placed; Book.price may change later.
+    price = models.PositiveIntegerField(null=True)
+
+
+class SalesRollup(models.Model):
+    """Revenue and units of paid orders for one period and dimension value.
+
+    ``period`` is "day" or "month"; month rows are dated on the 1st. ``key`` is
+    empty for the "day" dimension, the genre for "genre" and the author or book
+    id for "author" and "book". Maintained by ``api.rollups``.
+    """
+
+    dimension = models.CharField(max_length=16)
+    period = models.CharField(max_length=8)
+    key = models.CharField(max_length=255, blank=True)
+    day = models.DateField()
+    revenue = models.BigIntegerField(default=0)
+    units = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dimension", "period", "day", "key"],
+                name="salesrollup_unique",
+            ),
+        ]
+        indexes = [
+            # Covers /stats so a date range is answered from the index alone.
+            models.Index(
+                fields=["dimension", "period", "day", "key", "revenue", "units"],
+                name="salesrollup_stats_idx",
+            ),
+        ]
+
+
+class MonoEvent(models.Model):
+    """A verified Monobank webhook, appended by the callback view.
+
+    ``api.mono.process_events`` applies pending events and stamps
+    ``processed_at``; rows are never changed otherwise. A redelivered callback
+    has the same invoice and ``modifiedDate`` and is not stored twice.
+    """
+
+    invoice_id = models.CharField(max_length=255)
+    modified_date = models.DateTimeField()
+    reference = models.CharField(max_length=255)
+    status = models.CharField(max_length=255)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["invoice_id", "modified_date"], name="monoevent_unique"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["processed_at", "id"], name="monoevent_pending_idx"),
+        ]
 
 
 class MonoSettings(models.Model):
@@ -46,9 +168,18 @@ class MonoSettings(models.Model):
         try:
             return cls.objects.last().public_key
         except AttributeError:
-            key = requests.get(
-                "https://api.monobank.ua/api/merchant/pubkey",
-                headers={"X-Token": settings.MONOBANK_API_KEY},
-            ).json()["key"]
+            return cls.refresh_token()
+
+    @classmethod
+    def refresh_token(cls):
+        response = get_client("monobank").get(
+            "/api/merchant/pubkey",
+            headers={"X-Token": settings.MONOBANK_API_KEY},
+        )
+        response.raise_for_status()
+        key = response.json()["key"]
+        # Reloads after bad signatures usually fetch the same key again.
+        latest = cls.objects.last()
+        if latest is None or latest.public_key != key:
             cls.objects.create(public_key=key)
-            return key
+        return key
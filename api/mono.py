@@ -1,63 +1,98 @@
 import base64
 import hashlib
+import threading
+import time
+from datetime import timedelta
 
 import ecdsa
 import requests
 from django.conf import settings
-from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
 from django.http import JsonResponse
+from django.utils import timezone
 from rest_framework import status
 
-from api.models import Order, OrderItem, Book
+from api.cache import invalidate_books
+from api.models import Order, OrderItem, Book, MonoEvent, MonoSettings
+from api.outbound import get_client
+from api.rollups import update_statuses
+
+
+# Invoice statuses by how far along an invoice they come. Final statuses share
+# a rank, and "reversed" only follows "success".
+STATUS_RANKS = {
+    "created": 0,
+    "processing": 1,
+    "hold": 2,
+    "success": 3,
+    "failure": 3,
+    "expired": 3,
+    "reversed": 4,
+}
 
 
 def create_order(order_data, webhook_url):
+    quantities = {}
     for order_item in order_data:
-        book_id = order_item["book_id"].id
-        quantity = order_item["quantity"]
-        try:
-            book = Book.objects.get(id=book_id)
-            if quantity < 1:
-                return JsonResponse(
-                    {"error": "quantity must be greater than 0"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            if book.quantity < quantity:
-                return JsonResponse(
-                    {"error": f"available quantity = {book.quantity}"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-        except Book.DoesNotExist:
+        if order_item["quantity"] < 1:
             return JsonResponse(
-                {"error": "book not found"}, status=status.HTTP_404_NOT_FOUND
+                {"error": "quantity must be greater than 0"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
+        book_id = order_item["book_id"]
+        quantities[book_id] = quantities.get(book_id, 0) + order_item["quantity"]
 
-    basketOrder = []
-    order_items = []
-    amount = 0
-    order = Order.objects.create(total_price=0)
+    now = timezone.now()
+    with transaction.atomic():
+        books = {
+            book.id: book
+            for book in Book.objects.select_for_update()
+            .filter(id__in=quantities)
+            .order_by("id")
+        }
+        if len(books) != len(quantities):
+            return JsonResponse(
+                {"error": "book not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        for book_id, quantity in quantities.items():
+            if books[book_id].quantity < quantity:
+                return JsonResponse(
+                    {"error": f"available quantity = {books[book_id].quantity}"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            books[book_id].quantity -= quantity
+            books[book_id].updated_at = now
+        Book.objects.bulk_update(books.values(), ["quantity", "updated_at"])
 
-    for order_item in order_data:
-        item_sum = order_item["book_id"].price * order_item["quantity"]
-        basketOrder.append(
-            {
-                "name": order_item["book_id"].title,
-                "qty": order_item["quantity"],
-                "sum": item_sum,
-                "unit": "шт.",
-            }
+        order = Order.objects.create(
+            total_price=sum(
+                books[book_id].price * quantity
+                for book_id, quantity in quantities.items()
+            )
         )
-        item = OrderItem.objects.create(
-            book=order_item["book_id"], order=order, quantity=order_item["quantity"]
+        OrderItem.objects.bulk_create(
+            OrderItem(
+                book_id=book_id,
+                order=order,
+                quantity=quantity,
+                price=books[book_id].price,
+            )
+            for book_id, quantity in quantities.items()
         )
-        order_items.append(item)
-        amount += item_sum
-
-    order.total_price = amount
-    order.save()
+    invalidate_books(*quantities)
 
+    basketOrder = [
+        {
+            "name": books[book_id].title,
+            "qty": quantity,
+            "sum": books[book_id].price * quantity,
+            "unit": "шт.",
+        }
+        for book_id, quantity in quantities.items()
+    ]
     body = {
-        "amount": amount,
+        "amount": order.total_price,
         "merchantPaymInfo": {
             "reference": str(order.id),
             "basketOrder": basketOrder,
@@ -65,30 +100,145 @@ def create_order(order_data, webhook_url):
         "webHookUrl": webhook_url,
     }
 
-    r = requests.post(
-        "https://api.monobank.ua/api/merchant/invoice/create",
-        headers={"X-Token": settings.MONOBANK_API_KEY},
-        json=body,
+    # The stock is already reserved, so the slow Monobank call runs outside of
+    # the transaction and the reservation is released if it fails.
+    try:
+        r = get_client("monobank").post(
+            "/api/merchant/invoice/create",
+            headers={"X-Token": settings.MONOBANK_API_KEY},
+            json=body,
+        )
+        r.raise_for_status()
+        invoice = r.json()
+    except Exception:
+        release_order(order.id, quantities)
+        raise
+
+    Order.objects.filter(id=order.id).update(
+        invoice_id=invoice["invoiceId"], updated_at=timezone.now()
     )
-    r.raise_for_status()
-    order.invoice_id = r.json()["invoiceId"]
-    order.save()
+    return {"url": invoice["pageUrl"], "id": order.id}
 
-    for order_item in order_data:
-        book = Book.objects.get(id=order_item["book_id"].id)
-        book.quantity -= order_item["quantity"]
-        book.save()
-    cache.clear()
 
-    url = r.json()["pageUrl"]
-    return {"url": url, "id": order.id}
+def release_order(order_id, quantities):
+    now = timezone.now()
+    with transaction.atomic():
+        for book_id, quantity in quantities.items():
+            Book.objects.filter(id=book_id).update(
+                quantity=F("quantity") + quantity, updated_at=now
+            )
+        Order.objects.filter(id=order_id).update(status="failure", updated_at=now)
+    invalidate_books(*quantities)
+
+
+def store_event(callback, payload):
+    """Append a verified callback to the inbox; redeliveries are ignored."""
+    MonoEvent.objects.bulk_create(
+        [
+            MonoEvent(
+                invoice_id=callback["invoiceId"],
+                modified_date=callback.get("modifiedDate") or timezone.now(),
+                reference=callback["reference"],
+                status=callback["status"],
+                payload=payload,
+            )
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def _rank(status):
+    return STATUS_RANKS.get(status, -1)
+
+
+def process_events(batch_size=500):
+    """Apply pending inbox events to their orders, oldest ``batch_size`` first.
+
+    Each batch is one transaction. Events are claimed with SKIP LOCKED where
+    the database supports it, so several workers can drain the inbox. Events
+    find their order by ``reference``, the order id, and must carry its
+    invoice. Per invoice only the furthest event counts, and only if it moves
+    the order's status forward; stale, duplicate and unmatched events are just
+    marked processed. A callback that beats ``create_order`` to storing the
+    invoice id stays pending for MONOBANK_EVENT_RETRY_SECONDS, so a later run
+    applies it. Yields the number of processed events and of changed orders
+    per batch.
+    """
+    retry_after = timezone.now() - timedelta(
+        seconds=settings.MONOBANK_EVENT_RETRY_SECONDS
+    )
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                MonoEvent.objects.select_for_update(skip_locked=True)
+                .filter(processed_at=None, id__gt=last_id)
+                .order_by("id")[:batch_size]
+            )
+            if not events:
+                return
+            last_id = events[-1].id
+
+            latest = {}
+            for event in events:
+                key = event.invoice_id, event.reference
+                current = latest.get(key)
+                if current is None or (_rank(event.status), event.modified_date) > (
+                    _rank(current.status),
+                    current.modified_date,
+                ):
+                    latest[key] = event
+
+            orders = {
+                order.id: order
+                for order in Order.objects.select_for_update()
+                .filter(id__in=[int(ref) for _, ref in latest if ref.isdigit()])
+                .only("id", "invoice_id", "status")
+                .order_by("id")
+            }
+            statuses = {}
+            pending = set()
+            for (invoice_id, reference), event in latest.items():
+                order = orders.get(int(reference)) if reference.isdigit() else None
+                if order is None or order.invoice_id not in (None, invoice_id):
+                    continue
+                if order.invoice_id is None:
+                    if event.received_at > retry_after:
+                        pending.add((invoice_id, reference))
+                elif _rank(event.status) > _rank(statuses.get(order.id, order.status)):
+                    statuses[order.id] = event.status
+            changed = update_statuses(orders.values(), statuses)
+
+            processed = [
+                event.id
+                for event in events
+                if (event.invoice_id, event.reference) not in pending
+            ]
+            MonoEvent.objects.filter(id__in=processed).update(
+                processed_at=timezone.now()
+            )
+        yield len(processed), len(changed)
+
+
+_verifying_keys = {}
+_verifying_keys_lock = threading.Lock()
+
+
+def get_verifying_key(pub_key_base64):
+    fingerprint = hashlib.sha256(pub_key_base64.encode()).hexdigest()
+    key = _verifying_keys.get(fingerprint)
+    if key is None:
+        pub_key_bytes = base64.b64decode(pub_key_base64)
+        key = ecdsa.VerifyingKey.from_pem(pub_key_bytes.decode())
+        with _verifying_keys_lock:
+            _verifying_keys[fingerprint] = key
+    return key
 
 
 def verify_signature(pub_key_base64, x_sign_base64, body_bytes):
     try:
-        pub_key_bytes = base64.b64decode(pub_key_base64)
         signature_bytes = base64.b64decode(x_sign_base64)
-        pub_key = ecdsa.VerifyingKey.from_pem(pub_key_bytes.decode())
+        pub_key = get_verifying_key(pub_key_base64)
         ok = pub_key.verify(
             signature_bytes,
             body_bytes,
@@ -102,3 +252,57 @@ def verify_signature(pub_key_base64, x_sign_base64, body_bytes):
         return True
     else:
         return False
+
+
+class WebhookVerifier:
+    """Verifies Monobank webhook signatures against a cached public key.
+
+    The key is read from ``MonoSettings`` once per process. On a mismatch it is
+    reloaded (database first, then Monobank) at most once per
+    ``reload_interval`` seconds to pick up a rotated key.
+    """
+
+    def __init__(self, reload_interval=60):
+        self.reload_interval = reload_interval
+        self._public_key = None
+        self._last_reload = None
+        self._lock = threading.Lock()
+
+    def _can_reload(self):
+        return (
+            self._last_reload is None
+            or time.monotonic() - self._last_reload >= self.reload_interval
+        )
+
+    def _reload(self):
+        self._last_reload = time.monotonic()
+        key = MonoSettings.get_token()
+        if key == self._public_key:
+            try:
+                key = MonoSettings.refresh_token()
+            except (requests.RequestException, ValueError, KeyError):
+                return
+        self._public_key = key
+
+    def verify(self, x_sign_base64, body_bytes):
+        if self._public_key is None:
+            with self._lock:
+                if self._public_key is None:
+                    self._public_key = MonoSettings.get_token()
+
+        if verify_signature(self._public_key, x_sign_base64, body_bytes):
+            return True
+
+        with self._lock:
+            if not self._can_reload():
+                return False
+            self._reload()
+        return verify_signature(self._public_key, x_sign_base64, body_bytes)
+
+    def reset(self):
+        with self._lock:
+            self._public_key = None
+            self._last_reload = None
+
+
+webhook_verifier = WebhookVerifier(settings.MONOBANK_KEY_RELOAD_INTERVAL)
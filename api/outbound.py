@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .metrics import observe_outbound
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures.
+
+    While open every call is refused; after ``reset_timeout`` seconds a single
+    trial call is let through and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._trial or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class OutboundClient:
+    """Keep-alive session for one upstream with timeouts, retries and a breaker.
+
+    Only idempotent methods are retried by default, on connection errors,
+    timeouts and ``retry_statuses``, with exponential backoff and full jitter.
+    Relative URLs are joined to ``base_url`` so tests can point the client at
+    a local stub server.
+    """
+
+    idempotent_methods = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+    retry_statuses = frozenset({429, 502, 503, 504})
+
+    def __init__(
+        self,
+        name,
+        base_url,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff=0.1,
+        pool_size=10,
+        failure_threshold=5,
+        reset_timeout=30,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "short_circuited": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _observe(self, started, status):
+        latency = time.perf_counter() - started
+        observe_outbound(self.name, status, latency)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["errors"] += int(status == "error" or status >= 500)
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+    def url(self, path):
+        if "://" in path:
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method, path, retry=None, **kwargs):
+        method = method.upper()
+        if retry is None:
+            retry = method in self.idempotent_methods
+        attempts = 1 + (self.retries if retry else 0)
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                self._count("short_circuited")
+                raise CircuitOpenError(f"{self.name} circuit is open")
+
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._observe(started, "error")
+                self.breaker.record_failure()
+                if attempt == attempts:
+                    raise
+            except BaseException:
+                # Any other outcome still ends a half-open trial.
+                self._observe(started, "error")
+                self.breaker.record_failure()
+                raise
+            else:
+                failed = response.status_code >= 500
+                self._observe(started, response.status_code)
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if response.status_code not in self.retry_statuses:
+                    return response
+                if attempt == attempts:
+                    return response
+
+            self._count("retries")
+            time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    """Shared client for an upstream configured in ``settings.OUTBOUND_HTTP``."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = OutboundClient(name, **settings.OUTBOUND_HTTP[name])
+                _clients[name] = client
+    return client
+
+
+def reset_clients():
+    with _clients_lock:
+        _clients.clear()
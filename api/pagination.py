@@ -0,0 +1,165 @@
+import base64
+import json
+from collections import OrderedDict
+from datetime import date
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """``LimitOffsetPagination`` with an opt-in keyset mode.
+
+    Passing ``?cursor=`` (empty for the first page) switches to keyset
+    pagination: rows are ordered by ``(ordering field, id)`` and each page
+    starts after the last row of the previous one, so no rows are skipped with
+    OFFSET and no COUNT is run. Views choose the allowed sort fields with
+    ``keyset_ordering_fields`` and the default with ``keyset_default_ordering``.
+
+    ``?ordering=`` sorts offset pages the same way, and unordered querysets
+    get the default ordering, so pages stay stable between requests. As in
+    offset mode, a first page without rows sets ``count`` to 0 so views can
+    answer 404, while a page past the last row is empty.
+    """
+
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            queryset = self.offset_queryset(queryset, request, view)
+            return super().paginate_queryset(queryset, request, view)
+
+        queryset = self.keyset_queryset(queryset, request, view)
+        return self.keyset_page(list(queryset[: self.limit + 1]))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` for async views, using the async ORM."""
+        self.keyset = self.cursor_query_param in request.query_params
+        if self.keyset:
+            queryset = self.keyset_queryset(queryset, request, view)
+            return self.keyset_page([obj async for obj in queryset[: self.limit + 1]])
+
+        queryset = self.offset_queryset(queryset, request, view)
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.count = await queryset.acount()
+        self.offset = self.get_offset(request)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        if self.count == 0 or self.offset > self.count:
+            return []
+        return [obj async for obj in queryset[self.offset : self.offset + self.limit]]
+
+    def order_queryset(self, queryset, request, view):
+        self.ordering = self.get_ordering(request, view)
+        if self.ordering.lstrip("-") == "id":
+            return queryset.order_by(self.ordering)
+        descending = self.ordering.startswith("-")
+        return queryset.order_by(self.ordering, "-id" if descending else "id")
+
+    def offset_queryset(self, queryset, request, view):
+        # Keep the order a search backend ranks results in unless asked.
+        if self.ordering_query_param in request.query_params or not queryset.ordered:
+            return self.order_queryset(queryset, request, view)
+        return queryset
+
+    def keyset_queryset(self, queryset, request, view):
+        self.request = request
+        self.count = None
+        self.limit = self.get_limit(request)
+        queryset = self.order_queryset(queryset, request, view)
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+
+        self.cursor = request.query_params[self.cursor_query_param]
+        if self.cursor:
+            value, pk = self.decode_cursor(self.cursor)
+            if field != "id":
+                value = self.cursor_value(queryset, field, value)
+            after = "lt" if descending else "gt"
+            position = Q(**{f"id__{after}": pk})
+            if field != "id":
+                position = Q(**{f"{field}__{after}": value}) | (
+                    Q(**{field: value}) & position
+                )
+            queryset = queryset.filter(position)
+        return queryset
+
+    def keyset_page(self, results):
+        self.next_cursor = None
+        if not results and not self.cursor:
+            self.count = 0
+        if len(results) > self.limit:
+            results = results[: self.limit]
+            last = results[-1]
+            field = self.ordering.lstrip("-")
+            if isinstance(last, dict):  # a values() row
+                value, pk = last[field], last["id"]
+            else:
+                value, pk = getattr(last, field), last.pk
+            self.next_cursor = self.encode_cursor(value, pk)
+        return results
+
+    def get_ordering(self, request, view):
+        ordering = request.query_params.get(self.ordering_query_param) or getattr(
+            view, "keyset_default_ordering", "id"
+        )
+        if ordering.lstrip("-") not in getattr(view, "keyset_ordering_fields", ["id"]):
+            raise ParseError("invalid ordering")
+        return ordering
+
+    def encode_cursor(self, value, pk):
+        if isinstance(value, date):
+            value = value.isoformat()
+        data = json.dumps({"o": self.ordering, "v": value, "id": pk})
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if data["o"] != self.ordering:
+                raise ValueError
+            return data["v"], int(data["id"])
+        except (ValueError, TypeError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def cursor_value(self, queryset, field, value):
+        """The cursor's ``field`` value as the model field's Python type."""
+        if not isinstance(value, (str, int)) or isinstance(value, bool):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            return queryset.model._meta.get_field(field).to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_data(self, data):
+        if not self.keyset:
+            return OrderedDict(
+                [
+                    ("count", self.count),
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        return {"next": self.get_next_link(), "results": data}
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
@@ -0,0 +1,33 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+
+class ORJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` producing the same bytes through orjson.
+
+    orjson writes compact UTF-8 like DRF's defaults. Dates, times, Decimals
+    and the other types DRF's encoder knows are handed to that encoder so they
+    are formatted the same way, and U+2028/U+2029 are escaped as DRF does.
+    Indented output and non-default renderer settings use ``JSONRenderer``.
+    Floats would be written in orjson's shortest form, so this is only used
+    for responses without them.
+    """
+
+    options = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if (
+            self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(
+            data, default=self.encoder_class().default, option=self.options
+        )
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
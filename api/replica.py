@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+REPLICA = "replica"
+STICKY_COOKIE = "primary_reads"
+
+_client = ContextVar("replica_client", default=None)
+_use_replica = ContextVar("use_replica", default=False)
+
+
+class _Client:
+    def __init__(self, sticky):
+        self.sticky = sticky
+        self.wrote = False
+
+
+class ReplicaRouter:
+    """Sends reads inside ``replica_reads`` views to the ``replica`` database.
+
+    Everything else, and every write, goes to the primary. Without a
+    ``replica`` alias in DATABASES all queries use the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and REPLICA in connections.settings:
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        client = _client.get()
+        if client is not None:
+            client.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the primary's rows.
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # The replica gets the schema from the primary.
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    """Keeps a client that wrote on the primary for REPLICA_STICKY_SECONDS.
+
+    A response to a request that wrote sets a cookie for that long, and
+    requests carrying it read from the primary, so the client sees its own
+    writes even when the replica lags behind.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        client = _Client(STICKY_COOKIE in request.COOKIES)
+        token = _client.set(client)
+        try:
+            response = self.get_response(request)
+        finally:
+            _client.reset(token)
+        return self.stick(client, response)
+
+    async def __acall__(self, request):
+        client = _Client(STICKY_COOKIE in request.COOKIES)
+        token = _client.set(client)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _client.reset(token)
+        return self.stick(client, response)
+
+    def stick(self, client, response):
+        if client.wrote:
+            response.set_cookie(
+                STICKY_COOKIE,
+                "1",
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+
+@contextmanager
+def _reads(replica):
+    token = _use_replica.set(replica)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def primary_reads():
+    """Read from the primary inside a ``replica_reads`` view."""
+    return _reads(False)
+
+
+def replica_reads(view_func):
+    """Run the sync or async ``view_func`` with its reads on the replica.
+
+    Clients that wrote in the last REPLICA_STICKY_SECONDS keep reading from
+    the primary, see ``ReplicaMiddleware``.
+    """
+
+    def replica():
+        client = _client.get()
+        return client is None or not client.sticky
+
+    if iscoroutinefunction(view_func):
+
+        @wraps(view_func)
+        async def wrapper(*args, **kwargs):
+            with _reads(replica()):
+                return await view_func(*args, **kwargs)
+
+    else:
+
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            with _reads(replica()):
+                return view_func(*args, **kwargs)
+
+    return wrapper
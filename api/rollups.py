@@ -0,0 +1,195 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Author, Book, Order, OrderItem, SalesRollup
+
+
+PAID = "success"
+DIMENSIONS = ("day", "genre", "author", "book")
+
+# Rows per INSERT, below SQLite's 999 bound parameters.
+UPSERT_BATCH = 150
+
+
+def _periods(start, end):
+    """Cover ``start``..``end`` with whole months plus the days at the edges."""
+    first_month = start if start.day == 1 else _next_month(start)
+    after_last_month = end + timedelta(days=1)
+    if after_last_month.day != 1:
+        after_last_month = end.replace(day=1)
+    if first_month >= after_last_month:
+        return Q(period="day", day__range=(start, end))
+    return (
+        Q(period="day", day__gte=start, day__lt=first_month)
+        | Q(period="month", day__gte=first_month, day__lt=after_last_month)
+        | Q(period="day", day__gte=after_last_month, day__lte=end)
+    )
+
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def sales(items):
+    """Revenue and units of ``items`` grouped by order day and book."""
+    return (
+        items.annotate(day=TruncDate("order__created_at"))
+        .values("day", "book_id", "book__genre", "book__author_id")
+        .annotate(
+            revenue=Sum(F("quantity") * Coalesce("price", "book__price")),
+            units=Sum("quantity"),
+        )
+        .order_by()
+    )
+
+
+def rollup_rows(sales_rows, sign=1):
+    """Fan per-book sales out to day and month rows of every dimension.
+
+    Returns ``{(dimension, period, day, key): [revenue, units]}``.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for row in sales_rows:
+        keys = (
+            ("day", ""),
+            ("genre", row["book__genre"]),
+            ("author", str(row["book__author_id"])),
+            ("book", str(row["book_id"])),
+        )
+        periods = (("day", row["day"]), ("month", row["day"].replace(day=1)))
+        for dimension, key in keys:
+            for period, day in periods:
+                total = totals[dimension, period, day, key]
+                total[0] += sign * row["revenue"]
+                total[1] += sign * row["units"]
+    return totals
+
+
+def apply(totals):
+    """Add ``totals`` to the rollup table with INSERT ... ON CONFLICT.
+
+    Postgres and SQLite share the syntax, so concurrent callbacks increment
+    the same rows without reading them first.
+    """
+    table = connection.ops.quote_name(SalesRollup._meta.db_table)
+    unique = ", ".join(
+        map(connection.ops.quote_name, ("dimension", "period", "day", "key"))
+    )
+    revenue, units = map(connection.ops.quote_name, ("revenue", "units"))
+    rows = [(*row_key, *values) for row_key, values in totals.items()]
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[start : start + UPSERT_BATCH]
+            cursor.execute(
+                f"INSERT INTO {table} ({unique}, {revenue}, {units}) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(batch))} "
+                f"ON CONFLICT ({unique}) DO UPDATE SET "
+                f"{revenue} = {table}.{revenue} + excluded.{revenue}, "
+                f"{units} = {table}.{units} + excluded.{units}",
+                [value for row in batch for value in row],
+            )
+
+
+def record_orders(order_ids, sign=1):
+    items = OrderItem.objects.filter(order_id__in=order_ids)
+    apply(rollup_rows(sales(items), sign))
+
+
+def update_statuses(orders, statuses):
+    """Save ``statuses``, ``{order id: status}``, on ``orders`` in bulk.
+
+    Orders paid or unpaid by the change are moved into or out of the rollups.
+    The caller holds row locks on ``orders`` so concurrent updates count an
+    order once. Returns the orders that changed.
+    """
+    now = timezone.now()
+    changed, paid, unpaid = [], [], []
+    for order in orders:
+        status = statuses.get(order.id, order.status)
+        if status == order.status:
+            continue
+        if status == PAID:
+            paid.append(order.id)
+        elif order.status == PAID:
+            unpaid.append(order.id)
+        order.status = status
+        order.updated_at = now
+        changed.append(order)
+    Order.objects.bulk_update(changed, ["status", "updated_at"])
+    if paid:
+        record_orders(paid, 1)
+    if unpaid:
+        record_orders(unpaid, -1)
+    return changed
+
+
+def rebuild(batch_size=10000):
+    """Recompute the rollups from all paid orders, ``batch_size`` at a time.
+
+    Runs in one transaction and yields the number of orders done so far.
+    """
+    with transaction.atomic():
+        SalesRollup.objects.all().delete()
+        paid = Order.objects.filter(status=PAID).order_by("id")
+        last_id = 0
+        done = 0
+        while ids := list(
+            paid.filter(id__gt=last_id).values_list("id", flat=True)[:batch_size]
+        ):
+            items = OrderItem.objects.filter(
+                order__status=PAID, order_id__gt=last_id, order_id__lte=ids[-1]
+            )
+            apply(rollup_rows(sales(items)))
+            last_id = ids[-1]
+            done += len(ids)
+            yield done
+
+
+def stats(dimension, start, end, limit):
+    """Rollup totals between ``start`` and ``end``, both inclusive.
+
+    "day" returns one row per day in date order, the other dimensions the
+    ``limit`` values with the highest revenue.
+    """
+    rows = SalesRollup.objects.filter(dimension=dimension)
+    if dimension == "day":
+        rows = rows.filter(period="day", day__range=(start, end))
+        return [
+            {"day": row["day"], "revenue": row["revenue"], "units": row["units"]}
+            for row in rows.values("day", "revenue", "units").order_by("day")
+        ]
+
+    # Whole months come from the month rows, so a year reads about 12 rows
+    # per value instead of 365.
+    rows = list(
+        rows.filter(_periods(start, end))
+        .values("key")
+        .annotate(revenue=Sum("revenue"), units=Sum("units"))
+        .order_by("-revenue", "key")[:limit]
+    )
+    if dimension == "genre":
+        return [
+            {"genre": row["key"], "revenue": row["revenue"], "units": row["units"]}
+            for row in rows
+        ]
+
+    model, label, name = {
+        "author": (Author, "author", "name"),
+        "book": (Book, "title", "title"),
+    }[dimension]
+    ids = [int(row["key"]) for row in rows]
+    names = dict(model.objects.filter(id__in=ids).values_list("id", name))
+    return [
+        {
+            f"{dimension}_id": id,
+            label: names.get(id),
+            "revenue": row["revenue"],
+            "units": row["units"],
+        }
+        for id, row in zip(ids, rows)
+    ]
@@ -0,0 +1,158 @@
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+from django.utils.module_loading import import_string
+
+
+class LikeSearchBackend:
+    """Plain ``icontains`` filters; works on any database but scans the table."""
+
+    def filter(self, queryset, title=None, author=None, genre=None, search=None):
+        if title:
+            queryset = queryset.filter(title__icontains=title)
+        if author:
+            queryset = queryset.filter(author__name__icontains=author)
+        if genre:
+            queryset = queryset.filter(genre__icontains=genre)
+        if search:
+            queryset = queryset.filter(title__icontains=search)
+        return queryset
+
+
+class PostgresSearchBackend(LikeSearchBackend):
+    """Trigram-indexed substring filters and ranked, prefix-matching search.
+
+    ``title``/``author``/``genre`` keep their ``icontains`` semantics, served
+    by the ``gin_trgm_ops`` indexes from migration 0005. ``search`` matches
+    word prefixes against the title's ``tsvector`` index and orders by rank.
+    """
+
+    config = "simple"
+
+    def filter(self, queryset, title=None, author=None, genre=None, search=None):
+        from django.contrib.postgres.search import (
+            SearchQuery,
+            SearchRank,
+            SearchVector,
+        )
+
+        queryset = super().filter(queryset, title=title, author=author, genre=genre)
+        words = re.findall(r"\w+", search or "")
+        if search and not words:
+            return super().filter(queryset, search=search)
+        if words:
+            vector = SearchVector("title", config=self.config)
+            query = SearchQuery(
+                " & ".join(f"{word}:*" for word in words),
+                search_type="raw",
+                config=self.config,
+            )
+            queryset = (
+                queryset.annotate(search_vector=vector)
+                .filter(search_vector=query)
+                .annotate(search_rank=SearchRank(vector, query))
+                .order_by("-search_rank", "id")
+            )
+        return queryset
+
+
+class SQLiteSearchBackend(LikeSearchBackend):
+    """FTS5 trigram index (``api_book_fts``) kept in sync by triggers.
+
+    The trigram tokenizer answers case-insensitive substring matches, so the
+    filters keep their ``icontains`` semantics; terms shorter than three
+    characters cannot use it and fall back to ``icontains``. ``search`` results
+    are ordered by bm25 rank.
+    """
+
+    table = "api_book_fts"
+    min_term_length = 3
+
+    def filter(self, queryset, title=None, author=None, genre=None, search=None):
+        terms = []
+        short = {}
+        for column, value in (
+            ("title", title),
+            ("author", author),
+            ("genre", genre),
+            ("search", search),
+        ):
+            if not value:
+                continue
+            if len(value) < self.min_term_length:
+                short[column] = value
+                continue
+            fts_column = "title" if column == "search" else column
+            terms.append('{} : "{}"'.format(fts_column, value.replace('"', '""')))
+
+        queryset = super().filter(queryset, **short)
+        if not terms:
+            return queryset
+
+        match = " AND ".join(terms)
+        queryset = queryset.extra(
+            tables=[self.table],
+            where=[f"{self.table}.rowid = api_book.id", f"{self.table} MATCH %s"],
+            params=[match],
+        )
+        if search and "search" not in short:
+            queryset = queryset.extra(
+                select={"search_rank": f"{self.table}.rank"},
+                order_by=["search_rank", "id"],
+            )
+        return queryset
+
+
+VENDOR_BACKENDS = {
+    "postgresql": PostgresSearchBackend,
+    "sqlite": SQLiteSearchBackend,
+}
+
+
+def get_search_backend():
+    if settings.SEARCH_BACKEND:
+        return import_string(settings.SEARCH_BACKEND)()
+    return VENDOR_BACKENDS.get(connection.vendor, LikeSearchBackend)()
+
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS api_book_fts_insert AFTER INSERT ON api_book BEGIN
+        INSERT INTO api_book_fts(rowid, title, author, genre)
+        SELECT new.id, new.title, name, new.genre
+        FROM api_author WHERE id = new.author_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_book_fts_update AFTER UPDATE ON api_book BEGIN
+        DELETE FROM api_book_fts WHERE rowid = old.id;
+        INSERT INTO api_book_fts(rowid, title, author, genre)
+        SELECT new.id, new.title, name, new.genre
+        FROM api_author WHERE id = new.author_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_book_fts_delete AFTER DELETE ON api_book BEGIN
+        DELETE FROM api_book_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_author_fts_update
+    AFTER UPDATE OF name ON api_author BEGIN
+        UPDATE api_book_fts SET author = new.name
+        WHERE rowid IN (SELECT id FROM api_book WHERE author_id = new.id);
+    END
+    """,
+]
+
+
+def install_sqlite_triggers(using="default", **kwargs):
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+    if SQLiteSearchBackend.table not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for statement in SQLITE_TRIGGERS:
+            cursor.execute(statement)
@@ -1,6 +1,9 @@
+from operator import itemgetter
+
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
-from .models import Author, Book, Order
+from .models import Author, Book, Order, OrderItem
 
 
 class AuthorSerializer(serializers.ModelSerializer):
@@ -25,8 +28,98 @@ class BookSerializer(serializers.ModelSerializer):
         )
 
 
+class BookPatchListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        ids = [change["id"] for change in attrs]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError("each book id should appear once")
+        return attrs
+
+
+class BookPatchSerializer(serializers.ModelSerializer):
+    """One change of a ``PATCH /books/bulk`` batch: a book id and the fields to set."""
+
+    id = serializers.IntegerField()
+    author = serializers.CharField(max_length=255, required=False)
+
+    class Meta:
+        model = Book
+        list_serializer_class = BookPatchListSerializer
+        fields = (
+            "id",
+            "title",
+            "author",
+            "genre",
+            "price",
+            "quantity",
+            "publication_date",
+        )
+        extra_kwargs = {
+            "title": {"required": False},
+            "genre": {"required": False},
+            "price": {"required": False, "min_value": 0},
+            "quantity": {"required": False},
+            "publication_date": {"required": False},
+        }
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict) and not set(data).issubset(self.fields):
+            unknown = ", ".join(sorted(set(data) - set(self.fields)))
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: [f"unknown fields: {unknown}"]}
+            )
+        return super().to_internal_value(data)
+
+
+class ValuesSerializer:
+    """Read-only ``serializer_class(many=True).data`` from ``values()`` rows.
+
+    The serializer's fields are compiled once into the columns to fetch and a
+    getter plus formatters, so list responses skip model instances and DRF's
+    per-field machinery. Only fields whose representation is the column value
+    (integers, strings) or a date/datetime are supported.
+    """
+
+    plain_fields = (serializers.IntegerField, serializers.CharField)
+    formatted_fields = (serializers.DateField, serializers.DateTimeField)
+
+    def __init__(self, serializer_class):
+        fields = serializer_class().fields
+        self.names = tuple(fields)
+        self.columns = tuple(
+            field.source.replace(".", "__") for field in fields.values()
+        )
+        self.formatters = []
+        for index, field in enumerate(fields.values()):
+            if isinstance(field, self.formatted_fields):
+                self.formatters.append((index, field.to_representation))
+            elif type(field) not in self.plain_fields:
+                raise TypeError(f"{type(field).__name__} is not supported")
+        self.getter = itemgetter(*self.columns)
+        if len(self.columns) == 1:
+            column = self.columns[0]
+            self.getter = lambda row: (row[column],)
+
+    def values(self, queryset):
+        return queryset.values(*self.columns)
+
+    def data(self, rows):
+        names, getter = self.names, self.getter
+        if not self.formatters:
+            return [dict(zip(names, getter(row))) for row in rows]
+
+        data = []
+        for row in rows:
+            values = list(getter(row))
+            for index, formatter in self.formatters:
+                if values[index] is not None:
+                    values[index] = formatter(values[index])
+            data.append(dict(zip(names, values)))
+        return data
+
+
 class OrderContentSerializer(serializers.Serializer):
-    book_id = serializers.PrimaryKeyRelatedField(queryset=Book.objects.all())
+    book_id = serializers.IntegerField()
     quantity = serializers.IntegerField()
 
 
@@ -34,10 +127,35 @@ class OrderSerializer(serializers.Serializer):
     order = OrderContentSerializer(many=True, allow_empty=False)
 
 
+class OrderItemSerializer(serializers.ModelSerializer):
+    book_id = serializers.IntegerField()
+    title = serializers.CharField(source="book.title")
+
+    class Meta:
+        model = OrderItem
+        fields = ("book_id", "title", "quantity", "price")
+
+
 class OrderModelSerializer(serializers.ModelSerializer):
+    """Expects ``orderitem_set__book`` to be prefetched, see ``ORDER_ITEMS``."""
+
+    books = serializers.SerializerMethodField()
+    items = OrderItemSerializer(source="orderitem_set", many=True)
+
     class Meta:
         model = Order
-        fields = ["total_price", "created_at", "invoice_id", "id", "books", "status"]
+        fields = [
+            "total_price",
+            "created_at",
+            "invoice_id",
+            "id",
+            "books",
+            "status",
+            "items",
+        ]
+
+    def get_books(self, order):
+        return [item.book_id for item in order.orderitem_set.all()]
 
 
 class MonoCallbackSerializer(serializers.Serializer):
@@ -46,3 +164,8 @@ class MonoCallbackSerializer(serializers.Serializer):
     amount = serializers.IntegerField()
     ccy = serializers.IntegerField()
     reference = serializers.CharField()
+    modifiedDate = serializers.DateTimeField(required=False)
+
+
+BOOK_VALUES = ValuesSerializer(BookSerializer)
+AUTHOR_VALUES = ValuesSerializer(AuthorSerializer)
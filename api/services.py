@@ -1,26 +1,130 @@
-import http.client
-import json
+import hashlib
+import threading
+import time
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
 
+from .models import Token
+from .outbound import get_client
 
-def get_access_token():
-    conn = http.client.HTTPSConnection(settings.AUTH0_DOMAIN)
-    payload = json.dumps(
-        {
-            "client_id": settings.AUTH0_CLIENT_ID,
-            "client_secret": settings.AUTH0_CLIENT_SECRET,
-            "audience": "https://bookstore/api",
-            "grant_type": "client_credentials",
-        }
-    )
-    headers = {"content-type": "application/json"}
-    conn.request("POST", "/oauth/token", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-
-    if res.status != 200:
-        raise Exception(f"Auth0 error: {res.status} - {data.decode()}")
-
-    token_data = json.loads(data)
-    return token_data["access_token"]
+
+def fetch_access_token():
+    """Run a client-credentials exchange, returning the token and its lifetime."""
+    payload = {
+        "client_id": settings.AUTH0_CLIENT_ID,
+        "client_secret": settings.AUTH0_CLIENT_SECRET,
+        "audience": "https://bookstore/api",
+        "grant_type": "client_credentials",
+    }
+    # A client-credentials exchange has no side effects, so it is safe to retry.
+    res = get_client("auth0").post("/oauth/token", json=payload, retry=True)
+
+    if res.status_code != 200:
+        raise Exception(f"Auth0 error: {res.status_code} - {res.text}")
+
+    token_data = res.json()
+    return token_data["access_token"], token_data.get("expires_in", 86400)
+
+
+class AccessTokenManager:
+    """The machine token for the API, reused until ``margin`` seconds before expiry.
+
+    The token is kept in memory and in the shared cache, so every worker of
+    every process reuses it. Refreshes are single-flight: in a process through
+    a lock, across processes through a cache lock whose losers wait up to
+    ``lock_timeout`` seconds for the winner's token. Signed-up subjects are
+    remembered in the cache so page views skip the ``Token`` lookup.
+    """
+
+    cache_key = "auth0.access_token"
+    lock_key = "auth0.access_token.lock"
+
+    def __init__(self, margin=60, lock_timeout=10):
+        self.margin = margin
+        self.lock_timeout = lock_timeout
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "cache_hits": 0, "refreshes": 0}
+
+    def _fresh(self, expires_at):
+        return expires_at - self.margin > time.time()
+
+    def _load(self):
+        cached = cache.get(self.cache_key)
+        if cached is not None and self._fresh(cached[1]):
+            self._token, self._expires_at = cached
+            return True
+        return False
+
+    def _refresh(self):
+        token, expires_in = fetch_access_token()
+        self.stats["refreshes"] += 1
+        self._token, self._expires_at = token, time.time() + expires_in
+        cache.set(
+            self.cache_key,
+            (self._token, self._expires_at),
+            max(1, int(expires_in - self.margin)),
+        )
+
+    def get(self):
+        if self._fresh(self._expires_at):
+            self.stats["memory_hits"] += 1
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed while this one waited.
+            if self._fresh(self._expires_at):
+                self.stats["memory_hits"] += 1
+                return self._token
+            if self._load():
+                self.stats["cache_hits"] += 1
+                return self._token
+
+            if cache.add(self.lock_key, 1, self.lock_timeout):
+                try:
+                    self._refresh()
+                finally:
+                    cache.delete(self.lock_key)
+                return self._token
+
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                if self._load():
+                    self.stats["cache_hits"] += 1
+                    return self._token
+            # The other process failed or is stuck; get a token of our own.
+            self._refresh()
+            return self._token
+
+    def _subject_key(self, sub):
+        return f"auth0.subject.{hashlib.md5(sub.encode()).hexdigest()}"
+
+    def register(self, sub):
+        """Store a ``Token`` row for ``sub`` unless one exists already."""
+        key = self._subject_key(sub)
+        if cache.get(key):
+            return
+        if not Token.objects.filter(sub=sub).exists():
+            try:
+                with transaction.atomic():
+                    Token.objects.create(sub=sub, token=self.get())
+            except IntegrityError:
+                pass  # Signed up by a concurrent request.
+        cache.set(key, True, None)
+
+    def clear(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+            for name in self.stats:
+                self.stats[name] = 0
+
+
+token_manager = AccessTokenManager(
+    margin=settings.AUTH0_ACCESS_TOKEN_MARGIN,
+    lock_timeout=settings.AUTH0_ACCESS_TOKEN_LOCK_TIMEOUT,
+)
@@ -1,10 +1,21 @@
+from django.conf import settings
 from django.urls import include, path
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import routers
 
-from . import views
+from . import async_views, views
 
 
+books_view = csrf_exempt(views.BooksView.as_view())
+book_view = csrf_exempt(views.BookView.as_view())
+authors_view = csrf_exempt(views.AuthorsView.as_view())
+author_view = csrf_exempt(views.AuthorView.as_view())
+if settings.ASYNC_CATALOG:
+    books_view = async_views.catalog_view(books_view, async_views.books)
+    book_view = async_views.catalog_view(book_view, async_views.book)
+    authors_view = async_views.catalog_view(authors_view, async_views.authors)
+    author_view = async_views.catalog_view(author_view, async_views.author)
+
 router = routers.DefaultRouter()
 router.register(r"orders", views.OrdersViewSet)
 
@@ -21,8 +32,17 @@ urlpatterns = [
         csrf_exempt(views.OrderCallbackView.as_view()),
         name="mono_callback",
     ),
-    path("books", csrf_exempt(views.BooksView.as_view()), name="books"),
-    path("books/<int:id>", csrf_exempt(views.BookView.as_view()), name="book"),
-    path("authors", csrf_exempt(views.AuthorsView.as_view()), name="authors"),
-    path("authors/<int:id>", csrf_exempt(views.AuthorView.as_view()), name="author"),
+    path("books", books_view, name="books"),
+    path("books/bulk", csrf_exempt(views.BooksBulkView.as_view()), name="books_bulk"),
+    path(
+        "books/import",
+        csrf_exempt(views.BooksImportView.as_view()),
+        name="books_import",
+    ),
+    path("books/export", views.books_export, name="books_export"),
+    path("books/<int:id>", book_view, name="book"),
+    path("orders/export", views.orders_export, name="orders_export"),
+    path("stats", views.StatsView.as_view(), name="stats"),
+    path("authors", authors_view, name="authors"),
+    path("authors/<int:id>", author_view, name="author"),
 ]
@@ -1,33 +1,195 @@
 import json
+import threading
+import time
+from collections import OrderedDict
 
 import jwt
 import requests
 from django.conf import settings
 
+from .outbound import get_client
+
 
 def jwt_get_username_from_payload_handler(payload):
     return "djangoauth0user"
 
 
-def jwt_decode_token(token):
-    header = jwt.get_unverified_header(token)
-    jwks = requests.get(
-        "https://{}/.well-known/jwks.json".format(settings.AUTH0_DOMAIN)
-    ).json()
-    public_key = None
+class JWKSKeyStore:
+    """Parsed Auth0 public keys indexed by ``kid`` plus an LRU of verified tokens.
+
+    Keys are kept for ``ttl`` seconds, after which they are refetched on a
+    background thread while requests keep using the old ones; only the first
+    fetch blocks. An unknown ``kid`` triggers a refetch at most once per
+    ``refresh_cooldown`` seconds. If Auth0 is unreachable the previously
+    fetched keys keep being used. Fetches run outside the lock guarding keys
+    and tokens, so a slow Auth0 only delays requests that need new keys.
+    """
+
+    def __init__(self, url, ttl=3600, refresh_cooldown=30, token_cache_size=256):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_cooldown = refresh_cooldown
+        self.token_cache_size = token_cache_size
+        self._keys = {}
+        self._fetched_at = None
+        self._last_refresh_attempt = None
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._refreshing = False
+        self.stats = {
+            "key_hits": 0,
+            "key_misses": 0,
+            "token_hits": 0,
+            "token_misses": 0,
+            "refreshes": 0,
+            "refresh_errors": 0,
+        }
+
+    def _fetch(self):
+        response = get_client("auth0").get(self.url)
+        response.raise_for_status()
+        return response.json()
+
+    def refresh(self):
+        """Fetch the keys, or wait for the fetch already in flight."""
+        with self._lock:
+            if self._refreshing:
+                self._refreshed.wait_for(lambda: not self._refreshing)
+                return True
+            self._refreshing = True
+            self._last_refresh_attempt = time.monotonic()
+            self.stats["refreshes"] += 1
+
+        keys = None
+        try:
+            jwks = self._fetch()
+            keys = {}
+            for jwk in jwks.get("keys", []):
+                if "kid" in jwk:
+                    keys[jwk["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(
+                        json.dumps(jwk)
+                    )
+        except (requests.RequestException, ValueError):
+            pass
+        finally:
+            with self._lock:
+                if keys is None:
+                    self.stats["refresh_errors"] += 1
+                else:
+                    self._keys = keys
+                    self._fetched_at = time.monotonic()
+                self._refreshing = False
+                self._refreshed.notify_all()
+        return keys is not None
+
+    def _is_stale(self):
+        return (
+            self._fetched_at is None or time.monotonic() - self._fetched_at > self.ttl
+        )
+
+    def _can_refresh(self):
+        return (
+            self._last_refresh_attempt is None
+            or time.monotonic() - self._last_refresh_attempt >= self.refresh_cooldown
+        )
+
+    def refresh_in_background(self):
+        self._last_refresh_attempt = time.monotonic()
+        thread = threading.Thread(target=self.refresh, daemon=True)
+        thread.start()
+        return thread
+
+    def get_key(self, kid):
+        with self._lock:
+            first_fetch = False
+            if self._is_stale() and self._can_refresh():
+                if self._keys:
+                    self.refresh_in_background()
+                else:
+                    first_fetch = True
+        if first_fetch:
+            self.refresh()
 
-    for jwk in jwks["keys"]:
-        if jwk["kid"] == header["kid"]:
-            public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is not None:
+                self.stats["key_hits"] += 1
+                return key
 
-    if public_key is None:
-        raise Exception("Public key not found.")
+            self.stats["key_misses"] += 1
+            if not self._can_refresh():
+                # A fetch in flight may bring this kid.
+                self._refreshed.wait_for(lambda: not self._refreshing)
+                return self._keys.get(kid)
+        self.refresh()
+        return self._keys.get(kid)
 
-    issuer = "https://{}/".format(settings.AUTH0_DOMAIN)
-    return jwt.decode(
+    def _get_cached_token(self, token):
+        with self._lock:
+            cached = self._tokens.get(token)
+            if cached is None:
+                self.stats["token_misses"] += 1
+                return None
+            payload, exp = cached
+            if exp is not None and exp <= time.time():
+                del self._tokens[token]
+                self.stats["token_misses"] += 1
+                return None
+            self._tokens.move_to_end(token)
+            self.stats["token_hits"] += 1
+            return dict(payload)
+
+    def _cache_token(self, token, payload):
+        if self.token_cache_size <= 0:
+            return
+        with self._lock:
+            self._tokens[token] = (dict(payload), payload.get("exp"))
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.token_cache_size:
+                self._tokens.popitem(last=False)
+
+    def decode(self, token, audience, issuer):
+        payload = self._get_cached_token(token)
+        if payload is not None:
+            return payload
+
+        header = jwt.get_unverified_header(token)
+        public_key = self.get_key(header.get("kid"))
+        if public_key is None:
+            raise jwt.InvalidTokenError("Public key not found.")
+
+        payload = jwt.decode(
+            token,
+            public_key,
+            audience=audience,
+            issuer=issuer,
+            algorithms=["RS256"],
+        )
+        self._cache_token(token, payload)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_refresh_attempt = None
+            self._tokens.clear()
+            for name in self.stats:
+                self.stats[name] = 0
+
+
+jwks_store = JWKSKeyStore(
+    settings.AUTH0_JWKS_URL,
+    ttl=settings.AUTH0_JWKS_TTL,
+    refresh_cooldown=settings.AUTH0_JWKS_REFRESH_COOLDOWN,
+    token_cache_size=settings.AUTH0_TOKEN_CACHE_SIZE,
+)
+
+
+def jwt_decode_token(token):
+    return jwks_store.decode(
         token,
-        public_key,
         audience="https://bookstore/api",
-        issuer=issuer,
-        algorithms=["RS256"],
+        issuer="https://{}/".format(settings.AUTH0_DOMAIN),
     )
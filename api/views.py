@@ -1,32 +1,58 @@
+import codecs
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from urllib.parse import quote_plus, urlencode
 
 from authlib.integrations.django_client import OAuth
 from django.conf import settings
-from django.core.cache import cache
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.views.decorators.http import require_GET
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters, permissions, status, viewsets
 from rest_framework.decorators import api_view
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Author, Book, Token, Order, MonoSettings
-from .mono import create_order, verify_signature
+from . import export
+from .cache import (
+    AUTHOR,
+    AUTHORS,
+    BOOK,
+    BOOKS,
+    cached_rows,
+    invalidate_authors,
+    invalidate_books,
+    versioned_cache_page,
+)
+from .filters import OrderFilter
+from .importer import BookImporter
+from .models import Author, Book, Order, OrderItem
+from .mono import create_order, store_event, webhook_verifier
+from .pagination import KeysetPagination
+from .replica import replica_reads
+from .rollups import DIMENSIONS, stats
+from .search import get_search_backend
+from .renderers import ORJSONRenderer
 from .serializers import (
+    AUTHOR_VALUES,
+    BOOK_VALUES,
     AuthorSerializer,
+    BookPatchSerializer,
     BookSerializer,
     OrderSerializer,
     OrderModelSerializer,
     MonoCallbackSerializer,
 )
-from .services import get_access_token
+from .services import token_manager
 
 
 oauth = OAuth()
@@ -45,8 +71,7 @@ oauth.register(
 def index(request):
     s = request.session.get("user")
     if s:
-        if s["userinfo"]["sub"] not in Token.objects.values_list("sub", flat=True):
-            Token.objects.create(sub=s["userinfo"]["sub"], token=get_access_token())
+        token_manager.register(s["userinfo"]["sub"])
 
     return render(
         request,
@@ -88,72 +113,123 @@ def logout(request):
 def token(request):
     s = request.session.get("user")
     if s:
-        t = Token.objects.filter(sub=s["userinfo"]["sub"]).values().first()
-        return JsonResponse({"access_token": t["token"]}, status=status.HTTP_200_OK)
+        token_manager.register(s["userinfo"]["sub"])
+        return JsonResponse(
+            {"access_token": token_manager.get()}, status=status.HTTP_200_OK
+        )
     else:
         return JsonResponse(
             {"msg": "need registration"}, status=status.HTTP_401_UNAUTHORIZED
         )
 
 
+BOOK_FILTER_PARAMS = {"title", "author", "genre", "publication_date", "search"}
+LIST_PARAMS = {"limit", "offset", "cursor", "ordering"}
+ORDER_FILTER_PARAMS = {"status", "created_at_after", "created_at_before"}
+EXPORT_PARAMS = {"format", "updated_since"}
+
+
+def filter_books(query_params, params=BOOK_FILTER_PARAMS | LIST_PARAMS):
+    """Book queryset for the list query params, or an error response."""
+    if not set(query_params.keys()).issubset(params):
+        return JsonResponse(
+            {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    queryset = Book.objects.select_related("author")
+
+    title = query_params.get("title")
+    author = query_params.get("author")
+    genre = query_params.get("genre")
+    publication_date = query_params.get("publication_date")
+    search = query_params.get("search")
+
+    if publication_date:
+        try:
+            formatted_date = datetime.strptime(publication_date, "%Y-%m-%d").date()
+            queryset = queryset.filter(publication_date=formatted_date)
+        except ValueError:
+            return JsonResponse(
+                {"error": "invalid publication_date format"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    return get_search_backend().filter(
+        queryset, title=title, author=author, genre=genre, search=search
+    )
+
+
+def parse_ids(query_params):
+    """Distinct ids of ``?ids=1,2,3`` in request order, or an error response."""
+    if set(query_params.keys()) != {"ids"}:
+        return JsonResponse(
+            {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        ids = list(dict.fromkeys(int(id) for id in query_params["ids"].split(",")))
+    except ValueError:
+        return JsonResponse(
+            {"error": "ids should be comma separated integers"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(ids) > settings.BOOKS_BULK_LIMIT:
+        return JsonResponse(
+            {"error": f"at most {settings.BOOKS_BULK_LIMIT} ids"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return ids
+
+
+def books_by_id(ids):
+    rows = BOOK_VALUES.values(Book.objects.filter(id__in=ids))
+    return {book["id"]: book for book in BOOK_VALUES.data(rows)}
+
+
+def books_by_ids_data(ids, books):
+    return {
+        "results": [books[id] for id in ids if id in books],
+        "not_found": [id for id in ids if id not in books],
+    }
+
+
 class BooksView(APIView):
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
+    keyset_ordering_fields = ["id", "price", "publication_date", "title"]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ["publication_date"]
     search_fields = ["title"]
 
-    @method_decorator(cache_page(60 * 15))
+    @method_decorator(replica_reads)
     def get(self, request):
-        params = {
-            "title",
-            "author",
-            "genre",
-            "limit",
-            "offset",
-            "publication_date",
-            "search",
-        }
-        if not set(request.GET.keys()).issubset(params):
-            return JsonResponse(
-                {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
-            )
-        else:
-            queryset = Book.objects.all()
-            if not queryset.exists():
-                return JsonResponse({"msg": "no books yet"}, status=status.HTTP_200_OK)
+        if "ids" in request.GET:
+            return self.get_by_ids(request)
+        return self.list(request)
+
+    def get_by_ids(self, request):
+        ids = parse_ids(request.GET)
+        if isinstance(ids, HttpResponse):
+            return ids
+        books = cached_rows(BOOK, ids, books_by_id, 60 * 15)
+        return Response(books_by_ids_data(ids, books))
+
+    @method_decorator(versioned_cache_page(60 * 15, BOOKS))
+    def list(self, request):
+        queryset = filter_books(request.GET)
+        if isinstance(queryset, HttpResponse):
+            return queryset
 
-        title = request.GET.get("title")
-        author = request.GET.get("author")
-        genre = request.GET.get("genre")
-        publication_date = request.GET.get("publication_date")
-        search = request.GET.get("search")
-
-        if title:
-            queryset = queryset.filter(title__icontains=title)
-        if author:
-            queryset = queryset.filter(author__name__icontains=author)
-        if genre:
-            queryset = queryset.filter(genre__icontains=genre)
-        if publication_date:
-            try:
-                formatted_date = datetime.strptime(publication_date, "%Y-%m-%d").date()
-                queryset = queryset.filter(publication_date=formatted_date)
-            except ValueError:
-                return JsonResponse(
-                    {"error": "invalid publication_date format"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-        if search:
-            queryset = queryset.filter(title__icontains=search)
-        if not queryset.exists():
+        paginator = self.pagination_class()
+        rows = paginator.paginate_queryset(
+            BOOK_VALUES.values(queryset), request, view=self
+        )
+        if paginator.count == 0:
+            if not Book.objects.exists():
+                return JsonResponse({"msg": "no books yet"}, status=status.HTTP_200_OK)
             return JsonResponse(
                 {"msg": "no books found by filters"}, status=status.HTTP_404_NOT_FOUND
             )
 
-        paginator = self.pagination_class()
-        paginated_queryset = paginator.paginate_queryset(queryset, request)
-        serializer = BookSerializer(paginated_queryset, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(BOOK_VALUES.data(rows))
 
     def post(self, request):
         serializer = BookSerializer(data=request.data)
@@ -161,7 +237,9 @@ class BooksView(APIView):
             return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         author_name = serializer.validated_data.pop("author")
-        author, _ = Author.objects.get_or_create(name=author_name["name"])
+        author, author_created = Author.objects.get_or_create_by_name(
+            author_name["name"]
+        )
 
         book = Book.objects.create(
             title=serializer.validated_data["title"],
@@ -173,18 +251,157 @@ class BooksView(APIView):
                 "publication_date", date.today()
             ),
         )
-        cache.clear()
+        invalidate_books(book.id)
+        if author_created:
+            invalidate_authors(author.id)
         return JsonResponse(
             {"id": book.id, "msg": "book added successfully"},
             status=status.HTTP_201_CREATED,
         )
 
 
+class BooksBulkView(APIView):
+    def patch(self, request):
+        changes = BookPatchSerializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.BOOKS_BULK_LIMIT,
+        )
+        if not changes.is_valid():
+            return JsonResponse(
+                changes.errors, status=status.HTTP_400_BAD_REQUEST, safe=False
+            )
+        changes = changes.validated_data
+        ids = [change["id"] for change in changes]
+
+        new_authors = []
+        with transaction.atomic():
+            books = Book.objects.select_for_update().in_bulk(ids)
+            not_found = [id for id in ids if id not in books]
+            if not_found:
+                return JsonResponse(
+                    {"error": "books not found", "ids": not_found},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+
+            authors = {}
+            for name in {change["author"] for change in changes if "author" in change}:
+                authors[name], created = Author.objects.get_or_create_by_name(name)
+                if created:
+                    new_authors.append(authors[name].id)
+
+            fields = {"updated_at"}
+            now = timezone.now()
+            for change in changes:
+                book = books[change.pop("id")]
+                if "author" in change:
+                    book.author = authors[change.pop("author")]
+                    fields.add("author")
+                for field, value in change.items():
+                    setattr(book, field, value)
+                fields.update(change)
+                book.updated_at = now
+            Book.objects.bulk_update(books.values(), sorted(fields))
+
+        invalidate_books(*ids)
+        if new_authors:
+            invalidate_authors(*new_authors)
+        return JsonResponse(
+            {"updated": len(ids), "msg": "books updated successfully"},
+            status=status.HTTP_200_OK,
+        )
+
+
+class BooksImportView(APIView):
+    content_types = {
+        "text/csv": "csv",
+        "application/x-ndjson": "ndjson",
+        "application/jsonl": "ndjson",
+    }
+
+    def post(self, request):
+        fmt = self.content_types.get(request.content_type.split(";")[0].strip())
+        if fmt is None:
+            return JsonResponse(
+                {"error": "content type should be text/csv or application/x-ndjson"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        lines = codecs.iterdecode(request.stream or [], "utf-8", errors="replace")
+        result = BookImporter().run(lines, fmt)
+        return JsonResponse(result, status=status.HTTP_200_OK)
+
+
+def parse_updated_since(query_params):
+    value = query_params.get("updated_since")
+    if not value:
+        return None
+    try:
+        updated_since = parse_datetime(value)
+    except ValueError:
+        updated_since = None
+    if updated_since is None:
+        raise ValueError(value)
+    if timezone.is_naive(updated_since):
+        updated_since = timezone.make_aware(updated_since)
+    return updated_since
+
+
+def export_response(request, queryset, rows, fields):
+    """Stream ``rows(queryset, chunk_size)`` as NDJSON or CSV."""
+    fmt = request.GET.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return JsonResponse(
+            {"error": "format should be ndjson or csv"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        updated_since = parse_updated_since(request.GET)
+    except ValueError:
+        return JsonResponse(
+            {"error": "updated_since should be an ISO 8601 datetime"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if updated_since is not None:
+        queryset = queryset.filter(updated_at__gte=updated_since)
+
+    chunk_size = settings.EXPORT_CHUNK_SIZE
+    content = export.encode(rows(queryset, chunk_size), fmt, fields, chunk_size)
+    if isinstance(request, ASGIRequest):
+        content = export.aiterate(content)
+    return StreamingHttpResponse(content, content_type=export.FORMATS[fmt])
+
+
+@require_GET
+def books_export(request):
+    queryset = filter_books(request.GET, BOOK_FILTER_PARAMS | EXPORT_PARAMS)
+    if isinstance(queryset, HttpResponse):
+        return queryset
+    return export_response(
+        request, queryset, export.book_rows, list(export.BOOK_FIELDS)
+    )
+
+
+@require_GET
+def orders_export(request):
+    if not set(request.GET.keys()).issubset(ORDER_FILTER_PARAMS | EXPORT_PARAMS):
+        return JsonResponse(
+            {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    filterset = OrderFilter(request.GET, queryset=Order.objects.all())
+    if not filterset.is_valid():
+        return JsonResponse(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+    return export_response(
+        request, filterset.qs, export.order_rows, export.ORDER_COLUMNS
+    )
+
+
 class BookView(APIView):
-    @method_decorator(cache_page(60 * 15))
+    @method_decorator(versioned_cache_page(60 * 15, BOOK))
     def get(self, request, id):
         try:
-            book = Book.objects.get(id=id)
+            book = Book.objects.select_related("author").get(id=id)
             serializer = BookSerializer(book)
             return Response(serializer.data)
         except Book.DoesNotExist:
@@ -220,8 +437,10 @@ class BookView(APIView):
                 book.title = request_body["title"]
             if "author" in request_body:
                 author_name = request_body["author"]
-                author, created = Author.objects.get_or_create(name=author_name)
+                author, created = Author.objects.get_or_create_by_name(author_name)
                 book.author = author
+                if created:
+                    invalidate_authors(author.id)
             if "genre" in request_body:
                 book.genre = request_body["genre"]
             if "price" in request_body:
@@ -239,7 +458,7 @@ class BookView(APIView):
                 book.publication_date = request_body["publication_date"]
 
             book.save()
-            cache.clear()
+            invalidate_books(id)
             return JsonResponse(
                 {"msg": "book updated successfully"}, status=status.HTTP_200_OK
             )
@@ -252,7 +471,7 @@ class BookView(APIView):
         try:
             book = Book.objects.get(id=id)
             book.delete()
-            cache.clear()
+            invalidate_books(id)
             return JsonResponse(
                 {"msg": "book deleted successfully"}, status=status.HTTP_200_OK
             )
@@ -262,48 +481,57 @@ class BookView(APIView):
             )
 
 
+def filter_authors(query_params):
+    """Author queryset for the list query params, or an error response."""
+    params = {"name", "limit", "offset", "cursor"}
+    if not set(query_params.keys()).issubset(params):
+        return JsonResponse(
+            {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    queryset = Author.objects.all()
+
+    name = query_params.get("name")
+    search = query_params.get("search")
+
+    if name:
+        queryset = queryset.filter(name__icontains=name)
+    if search:
+        queryset = queryset.filter(name__icontains=search)
+    return queryset
+
+
 class AuthorsView(APIView):
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
     filter_backends = [DjangoFilterBackend]
     search_fields = ["name"]
 
-    @method_decorator(cache_page(60 * 15))
+    @method_decorator(replica_reads)
+    @method_decorator(versioned_cache_page(60 * 15, AUTHORS))
     def get(self, request):
-        params = {"name", "limit", "offset"}
-        if not set(request.GET.keys()).issubset(params):
-            return JsonResponse(
-                {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
-            )
-        else:
-            queryset = Author.objects.all()
-            if not queryset.exists():
+        queryset = filter_authors(request.GET)
+        if isinstance(queryset, HttpResponse):
+            return queryset
+
+        paginator = self.pagination_class()
+        rows = paginator.paginate_queryset(
+            AUTHOR_VALUES.values(queryset), request, view=self
+        )
+        if paginator.count == 0:
+            if not Author.objects.exists():
                 return JsonResponse(
                     {"msg": "no authors yet"}, status=status.HTTP_200_OK
                 )
-
-        name = request.GET.get("name")
-        search = request.GET.get("search")
-
-        if name:
-            queryset = queryset.filter(name__icontains=name)
-        if search:
-            queryset = queryset.filter(name__icontains=search)
-
-        if not queryset.exists():
             return JsonResponse(
                 {"msg": "no authors found by filters"},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        paginator = self.pagination_class()
-        paginated_queryset = paginator.paginate_queryset(queryset, request)
-
-        serializer = AuthorSerializer(paginated_queryset, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(AUTHOR_VALUES.data(rows))
 
 
 class AuthorView(APIView):
-    @method_decorator(cache_page(60 * 15))
+    @method_decorator(versioned_cache_page(60 * 15, AUTHOR))
     def get(self, request, id):
         try:
             author = Author.objects.get(id=id)
@@ -315,11 +543,22 @@ class AuthorView(APIView):
             )
 
 
+ORDER_ITEMS = Prefetch(
+    "orderitem_set",
+    queryset=OrderItem.objects.select_related("book")
+    .only("order_id", "book_id", "quantity", "price", "book__title")
+    .order_by("id"),
+)
+
+
+@method_decorator(replica_reads, name="dispatch")
 class OrdersViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.AllowAny]
-    queryset = Order.objects.all().order_by("-id")
+    queryset = Order.objects.prefetch_related(ORDER_ITEMS).order_by("-id")
     serializer_class = OrderModelSerializer
-    pagination_class = LimitOffsetPagination
+    filterset_class = OrderFilter
+    pagination_class = KeysetPagination
+    keyset_default_ordering = "-id"
 
 
 class OrderView(APIView):
@@ -330,6 +569,8 @@ class OrderView(APIView):
         order.is_valid(raise_exception=True)
         webhook_url = request.build_absolute_uri(reverse("mono_callback"))
         order_data = create_order(order.validated_data["order"], webhook_url)
+        if isinstance(order_data, HttpResponse):
+            return order_data
         return Response(order_data)
 
 
@@ -337,30 +578,54 @@ class OrderCallbackView(APIView):
     permission_classes = [permissions.AllowAny]
 
     def post(self, request):
-        public_key = MonoSettings.get_token()
-
-        if not verify_signature(
-            public_key, request.headers.get("X-Sign"), request.body
-        ):
+        if not webhook_verifier.verify(request.headers.get("X-Sign"), request.body):
             return Response(
                 {"status": "signature mismatch"}, status=status.HTTP_400_BAD_REQUEST
             )
 
         callback = MonoCallbackSerializer(data=request.data)
         callback.is_valid(raise_exception=True)
+        # Applied by the process_mono_events command.
+        store_event(callback.validated_data, dict(request.data.items()))
+        return Response({"status": "ok"})
 
-        try:
-            order = Order.objects.get(id=callback.validated_data["reference"])
-        except Order.DoesNotExist:
-            return Response(
-                {"status": "order not found"}, status=status.HTTP_404_NOT_FOUND
+
+class StatsView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    max_limit = 1000
+
+    def get(self, request):
+        params = {"by", "from", "to", "limit"}
+        if not set(request.GET.keys()).issubset(params):
+            return JsonResponse(
+                {"error": "invalid query params"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        if order.invoice_id != callback.validated_data["invoiceId"]:
-            return Response(
-                {"status": "invoiceId mismatch"}, status=status.HTTP_400_BAD_REQUEST
+        dimension = request.GET.get("by", "day")
+        if dimension not in DIMENSIONS:
+            return JsonResponse(
+                {"error": f"by should be one of {', '.join(DIMENSIONS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            end = date.fromisoformat(request.GET.get("to") or date.today().isoformat())
+            start = date.fromisoformat(
+                request.GET.get("from") or (end - timedelta(days=29)).isoformat()
+            )
+            limit = min(int(request.GET.get("limit", 50)), self.max_limit)
+            if limit < 1:
+                raise ValueError(limit)
+        except ValueError:
+            return JsonResponse(
+                {"error": "dates should be yyyy-mm-dd and limit a positive number"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        order.status = callback.validated_data["status"]
-        order.save()
-        return Response({"status": "ok"})
+        return Response(
+            {
+                "by": dimension,
+                "from": start,
+                "to": end,
+                "results": stats(dimension, start, end, limit),
+            }
+        )
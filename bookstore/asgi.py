@@ -4,5 +4,6 @@ from django.core.asgi import get_asgi_application
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bookstore.settings")
+os.environ.setdefault("ASYNC_CATALOG", "True")
 
 application = get_asgi_application()
@@ -29,6 +29,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",
+    "api.replica.ReplicaMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,6 +83,17 @@ else:
         }
     }
 
+# Optional read replica for the catalog and order lists, e.g.
+# DATABASE_REPLICA_URL=sqlite:///replica.sqlite3 locally. Clients that wrote
+# keep reading from the primary for REPLICA_STICKY_SECONDS (api.replica).
+if config("DATABASE_REPLICA_URL", default=""):
+    DATABASES["replica"] = dj_database_url.parse(
+        config("DATABASE_REPLICA_URL"), conn_max_age=600
+    )
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+DATABASE_ROUTERS = ["api.replica.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = config("REPLICA_STICKY_SECONDS", default=5, cast=int)
+
 CACHES = {
     "default": {
         "BACKEND": "django_bmemcached.memcached.BMemcached",
@@ -93,6 +106,20 @@ CACHES = {
     }
 }
 
+# In-process tier in front of CACHES for catalog pages and version stamps
+# (api.cache.local_cache). Other processes see a change once their copy of
+# the stamps expires.
+LOCAL_CACHE_MAX_SIZE = config("LOCAL_CACHE_MAX_SIZE", default=32 * 2**20, cast=int)
+LOCAL_CACHE_STAMP_TIMEOUT = config("LOCAL_CACHE_STAMP_TIMEOUT", default=1, cast=float)
+
+# Catalog pages (api.cache.versioned_cache_page) expire within CACHE_PAGE_JITTER
+# of their timeout, are served for CACHE_PAGE_STALE_TIMEOUT more seconds while
+# one request rebuilds them, and others wait up to CACHE_PAGE_LOCK_TIMEOUT
+# seconds for a page being built.
+CACHE_PAGE_JITTER = config("CACHE_PAGE_JITTER", default=0.1, cast=float)
+CACHE_PAGE_STALE_TIMEOUT = config("CACHE_PAGE_STALE_TIMEOUT", default=300, cast=int)
+CACHE_PAGE_LOCK_TIMEOUT = config("CACHE_PAGE_LOCK_TIMEOUT", default=10, cast=int)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -139,10 +166,36 @@ REST_FRAMEWORK = {
     "DEFAULT_FILTER_BACKENDS": ["django_filters.rest_framework.DjangoFilterBackend"],
 }
 
+# Serve catalog GETs from api.async_views; bookstore/asgi.py turns this on.
+ASYNC_CATALOG = config("ASYNC_CATALOG", default=False, cast=bool)
+
+# Most books a GET /books?ids=... or PATCH /books/bulk request may name.
+BOOKS_BULK_LIMIT = config("BOOKS_BULK_LIMIT", default=500, cast=int)
+
+# Rows fetched per server-side cursor round trip by /books/export and
+# /orders/export.
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=2000, cast=int)
+
+# Dotted path to a class from api.search; picked by database vendor when empty.
+SEARCH_BACKEND = config("SEARCH_BACKEND", default="")
+
 AUTH0_DOMAIN = config("AUTH0_DOMAIN")
 AUTH0_CLIENT_ID = config("AUTH0_CLIENT_ID")
 AUTH0_CLIENT_SECRET = config("AUTH0_CLIENT_SECRET")
 AUTHORIZATION_HEADER = config("AUTHORIZATION_HEADER")
+AUTH0_BASE_URL = config("AUTH0_BASE_URL", default=f"https://{AUTH0_DOMAIN}")
+AUTH0_JWKS_URL = config(
+    "AUTH0_JWKS_URL", default=f"{AUTH0_BASE_URL}/.well-known/jwks.json"
+)
+AUTH0_JWKS_TTL = config("AUTH0_JWKS_TTL", default=3600, cast=int)
+AUTH0_JWKS_REFRESH_COOLDOWN = config(
+    "AUTH0_JWKS_REFRESH_COOLDOWN", default=30, cast=int
+)
+AUTH0_TOKEN_CACHE_SIZE = config("AUTH0_TOKEN_CACHE_SIZE", default=256, cast=int)
+AUTH0_ACCESS_TOKEN_MARGIN = config("AUTH0_ACCESS_TOKEN_MARGIN", default=60, cast=int)
+AUTH0_ACCESS_TOKEN_LOCK_TIMEOUT = config(
+    "AUTH0_ACCESS_TOKEN_LOCK_TIMEOUT", default=10, cast=int
+)
 
 JWT_AUTH = {
     "JWT_PAYLOAD_GET_USERNAME_HANDLER": "api.utils.jwt_get_username_from_payload_handler",
@@ -155,3 +208,25 @@ JWT_AUTH = {
 
 API_URL = config("API_URL", default="http://127.0.0.1:3000/api")
 MONOBANK_API_KEY = config("MONOBANK_API_KEY")
+MONOBANK_KEY_RELOAD_INTERVAL = config(
+    "MONOBANK_KEY_RELOAD_INTERVAL", default=60, cast=int
+)
+MONOBANK_API_URL = config("MONOBANK_API_URL", default="https://api.monobank.ua")
+# How long a callback for an order without its invoice id yet is retried.
+MONOBANK_EVENT_RETRY_SECONDS = config(
+    "MONOBANK_EVENT_RETRY_SECONDS", default=600, cast=int
+)
+
+# Shared outbound HTTP clients, see api.outbound.OutboundClient for the options.
+OUTBOUND_HTTP = {
+    "monobank": {
+        "base_url": MONOBANK_API_URL,
+        "connect_timeout": config("MONOBANK_CONNECT_TIMEOUT", default=3.05, cast=float),
+        "read_timeout": config("MONOBANK_READ_TIMEOUT", default=10, cast=float),
+    },
+    "auth0": {
+        "base_url": AUTH0_BASE_URL,
+        "connect_timeout": config("AUTH0_CONNECT_TIMEOUT", default=3.05, cast=float),
+        "read_timeout": config("AUTH0_READ_TIMEOUT", default=5, cast=float),
+    },
+}
@@ -0,0 +1,23 @@
+import os
+import shutil
+import tempfile
+
+
+# Workers share metrics through files in PROMETHEUS_MULTIPROC_DIR and /metrics
+# merges them, so a scrape sees every worker rather than the one that served it.
+# prometheus_client picks its storage on import, so set the directory first.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "bookstore-metrics")
+)
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
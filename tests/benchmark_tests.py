@@ -0,0 +1,310 @@
+"""Endpoint latency benchmarks against a seeded database and local upstream stubs.
+
+    pytest tests/benchmark_tests.py -s
+
+Each endpoint is requested BENCHMARK_REQUESTS times (default 50) through the
+Django test client with Monobank and Auth0 served by an in-process HTTP stub.
+p50/p95/p99 latency, throughput and queries per request are printed and
+written to BENCHMARK_RESULTS. With BENCHMARK_SAVE_BASELINE=1 the results are
+stored as the baseline (BENCHMARK_BASELINE); otherwise an endpoint fails when
+its p95 grows more than BENCHMARK_THRESHOLD (default 0.2) over the baseline or
+it runs more queries than the baseline did.
+"""
+import base64
+import hashlib
+import json
+import os
+import pathlib
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ecdsa
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from api.cache import local_cache
+from api.models import Author, Book, MonoSettings, Order
+from api.mono import webhook_verifier
+from api.outbound import reset_clients
+from api.utils import jwks_store
+
+
+root = pathlib.Path(__file__).parent
+
+REQUESTS = int(os.environ.get("BENCHMARK_REQUESTS", 50))
+BOOKS = int(os.environ.get("BENCHMARK_BOOKS", 5000))
+ORDERS = int(os.environ.get("BENCHMARK_ORDERS", 2000))
+THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", 0.2))
+CACHE_BACKEND = os.environ.get(
+    "BENCHMARK_CACHE", "django.core.cache.backends.dummy.DummyCache"
+)
+BASELINE = pathlib.Path(
+    os.environ.get("BENCHMARK_BASELINE", root / "fixtures" / "benchmark_baseline.json")
+)
+RESULTS = pathlib.Path(os.environ.get("BENCHMARK_RESULTS", "benchmark_results.json"))
+SAVE_BASELINE = os.environ.get("BENCHMARK_SAVE_BASELINE") == "1"
+
+CALLBACK_INVOICE = "benchmark-invoice"
+
+results = {}
+
+
+class UpstreamStub:
+    """Monobank and Auth0 endpoints served from a thread on localhost."""
+
+    def __init__(self):
+        self.rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.mono_key = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.rsa_key.public_key()))
+        jwk["kid"] = "benchmark"
+        self.invoices = 0
+        self.routes = {
+            ("GET", "/.well-known/jwks.json"): lambda: {"keys": [jwk]},
+            ("POST", "/oauth/token"): lambda: {
+                "access_token": "benchmark",
+                "expires_in": 86400,
+            },
+            ("GET", "/api/merchant/pubkey"): lambda: {"key": self.mono_public_key},
+            ("POST", "/api/merchant/invoice/create"): self.create_invoice,
+        }
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes; avoid delayed-ACK stalls.
+            disable_nagle_algorithm = True
+
+            def handle_route(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                route = stub.routes.get((self.command, self.path))
+                body = json.dumps(route() if route else {}).encode()
+                self.send_response(200 if route else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = handle_route
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def mono_public_key(self):
+        pem = self.mono_key.get_verifying_key().to_pem()
+        return base64.b64encode(pem).decode()
+
+    def create_invoice(self):
+        self.invoices += 1
+        invoice_id = f"stub-{self.invoices}"
+        return {"invoiceId": invoice_id, "pageUrl": f"{self.url}/pay/{invoice_id}"}
+
+    def sign_mono(self, body):
+        signature = self.mono_key.sign(
+            body, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der
+        )
+        return base64.b64encode(signature).decode()
+
+    def make_token(self):
+        payload = {
+            "sub": "benchmark",
+            "aud": "https://bookstore/api",
+            "iss": f"https://{settings.AUTH0_DOMAIN}/",
+            "exp": int(time.time()) + 3600,
+        }
+        return jwt.encode(
+            payload, self.rsa_key, algorithm="RS256", headers={"kid": "benchmark"}
+        ).decode()
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    stub = UpstreamStub()
+    stub.thread.start()
+    yield stub
+    stub.server.shutdown()
+
+
+@pytest.fixture(scope="module")
+def seeded(django_db_setup, django_db_blocker, upstream):
+    with django_db_blocker.unblock():
+        call_command("generate_books", BOOKS, seed=1, stdout=open(os.devnull, "w"))
+        call_command("generate_orders", ORDERS, seed=1, stdout=open(os.devnull, "w"))
+        stock = Book.objects.create(
+            title="Benchmark stock",
+            author=Author.objects.first(),
+            genre="Fiction",
+            price=100,
+            quantity=10**9,
+        )
+        order = Order.objects.create(total_price=100, invoice_id=CALLBACK_INVOICE)
+        MonoSettings.objects.create(public_key=upstream.mono_public_key)
+        get_user_model().objects.create(username="djangoauth0user")
+        yield {
+            "book": Book.objects.order_by("id").first().id,
+            "author": Author.objects.order_by("id").first().id,
+            "order": order.id,
+            "stock": stock.id,
+            "publication_date": Book.objects.order_by("id").first().publication_date,
+        }
+        call_command("flush", interactive=False, verbosity=0)
+
+
+@pytest.fixture
+def bench_settings(settings, upstream, monkeypatch):
+    settings.CACHES = {"default": {"BACKEND": CACHE_BACKEND}}
+    # local_cache is sized at import; with no room it stores nothing, so every
+    # request goes through BENCHMARK_CACHE.
+    monkeypatch.setattr(local_cache, "max_size", 0)
+    local_cache.clear()
+    settings.OUTBOUND_HTTP = {
+        name: dict(options, base_url=upstream.url)
+        for name, options in settings.OUTBOUND_HTTP.items()
+    }
+    reset_clients()
+    jwks_store.url = f"{upstream.url}/.well-known/jwks.json"
+    jwks_store.clear()
+    webhook_verifier.reset()
+    yield settings
+    reset_clients()
+    jwks_store.url = settings.AUTH0_JWKS_URL
+
+
+def callback_request(upstream, seeded):
+    body = json.dumps(
+        {
+            "invoiceId": CALLBACK_INVOICE,
+            "status": "success",
+            "amount": 100,
+            "ccy": 980,
+            "reference": str(seeded["order"]),
+        }
+    ).encode()
+    return {
+        "data": body,
+        "content_type": "application/json",
+        "HTTP_X_SIGN": upstream.sign_mono(body),
+    }
+
+
+ENDPOINTS = {
+    "books": ("get", "/api/books", None),
+    "books_title": ("get", "/api/books?title=the", None),
+    "books_author": ("get", "/api/books?author=an", None),
+    "books_genre": ("get", "/api/books?genre=fiction", None),
+    "books_publication_date": (
+        "get",
+        "/api/books?publication_date={publication_date}",
+        None,
+    ),
+    "books_search": ("get", "/api/books?search=the", None),
+    "books_all_filters": (
+        "get",
+        "/api/books?title=a&author=e&genre=fiction&search=the",
+        None,
+    ),
+    "books_deep_offset": ("get", f"/api/books?offset={BOOKS // 2}", None),
+    "books_cursor_price": ("get", "/api/books?cursor=&ordering=price", None),
+    "book": ("get", "/api/books/{book}", None),
+    "authors": ("get", "/api/authors", None),
+    "authors_name": ("get", "/api/authors?name=an", None),
+    "author": ("get", "/api/authors/{author}", None),
+    "orders": ("get", "/api/orders/", None),
+    "orders_cursor": ("get", "/api/orders/?cursor=", None),
+    "order_detail": ("get", "/api/orders/{order}/", None),
+    "place_order": (
+        "post",
+        "/api/order/",
+        lambda upstream, seeded: {
+            "data": {"order": [{"book_id": seeded["stock"], "quantity": 1}]},
+            "content_type": "application/json",
+        },
+    ),
+    "mono_callback": ("post", "/api/monobank/callback", callback_request),
+    "update_book": (
+        "put",
+        "/api/books/{book}",
+        lambda upstream, seeded: {
+            "data": {"price": 1000},
+            "content_type": "application/json",
+            "HTTP_AUTHORIZATION": f"Bearer {upstream.make_token()}",
+        },
+    ),
+}
+
+
+def percentile(latencies, p):
+    return statistics.quantiles(latencies, n=100, method="inclusive")[p - 1]
+
+
+def write_results():
+    RESULTS.write_text(json.dumps(results, indent=2, sort_keys=True))
+    if SAVE_BASELINE:
+        BASELINE.write_text(json.dumps(results, indent=2, sort_keys=True))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("name", ENDPOINTS)
+def test_endpoint_benchmark(name, seeded, upstream, bench_settings):
+    method, url, make_kwargs = ENDPOINTS[name]
+    url = url.format(**seeded)
+    kwargs = make_kwargs(upstream, seeded) if make_kwargs else {}
+    client = Client()
+    send = getattr(client, method)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = send(url, **kwargs)
+    # Read the count now: later requests reset the connection's query log.
+    query_count = len(queries)
+    assert response.status_code < 400, response.content
+
+    for _ in range(5):
+        send(url, **kwargs)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        request_started = time.perf_counter()
+        send(url, **kwargs)
+        latencies.append((time.perf_counter() - request_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "rps": round(REQUESTS / elapsed, 1),
+        "queries": query_count,
+    }
+    results[name] = result
+    write_results()
+    print(
+        f"\n{name:<24} "
+        "p50=%(p50_ms).2fms p95=%(p95_ms).2fms p99=%(p99_ms).2fms "
+        "%(rps).1f req/s %(queries)d queries" % result
+    )
+
+    if SAVE_BASELINE or not BASELINE.exists():
+        return
+    baseline = json.loads(BASELINE.read_text()).get(name)
+    if baseline is None:
+        return
+    assert (
+        result["queries"] <= baseline["queries"]
+    ), f"{name}: {result['queries']} queries, baseline {baseline['queries']}"
+    assert result["p95_ms"] <= baseline["p95_ms"] * (
+        1 + THRESHOLD
+    ), f"{name}: p95 {result['p95_ms']}ms, baseline {baseline['p95_ms']}ms"
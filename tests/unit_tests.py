@@ -1,13 +1,66 @@
+import asyncio
+import base64
+import hashlib
+import io
+import itertools
 import json
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from unittest.mock import MagicMock
 
+import ecdsa
+import jwt
 import pytest
 import requests
 import responses
+from asgiref.sync import async_to_sync
 from django.urls import reverse
 from django.conf import settings
-from api.models import Author, Book
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from api import async_views
+from api.cache import (
+    AUTHORS,
+    BOOK,
+    BOOKS,
+    VERSION_KEY,
+    async_versioned_cache_page,
+    bump_versions,
+    get_stamps,
+    invalidate_books,
+    local_cache,
+    versioned_cache_page,
+)
+from api.importer import BookImporter
+from api.models import (
+    Author,
+    Book,
+    MonoEvent,
+    MonoSettings,
+    Order,
+    OrderItem,
+    SalesRollup,
+    Token,
+)
+from api.mono import STATUS_RANKS, WebhookVerifier
+from api.outbound import CircuitOpenError, OutboundClient, reset_clients
+from api.search import LikeSearchBackend, SQLiteSearchBackend
+from api.serializers import AuthorSerializer, BookSerializer
+from api.services import AccessTokenManager, token_manager
+from api.utils import JWKSKeyStore
+from api.views import AuthorsView, BooksView
 
 
 root = pathlib.Path(__file__).parent
@@ -176,3 +229,1543 @@ def test_get_url_order(mocked):
     response = requests.post(f"{settings.API_URL}/order/", json=order_data)
     response_data = response.json()
     assert response_data == expected_result
+
+
+JWKS_URL = "https://auth.test/.well-known/jwks.json"
+
+
+@pytest.fixture
+def rsa_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def jwks_stub(rsa_key):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(rsa_key.public_key()))
+    jwk["kid"] = "test-kid"
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(responses.GET, JWKS_URL, json={"keys": [jwk]})
+        yield rsps
+
+
+def make_token(private_key, kid="test-kid", exp_in=3600):
+    payload = {
+        "sub": "user",
+        "aud": "https://bookstore/api",
+        "iss": "https://auth.test/",
+        "exp": int(time.time()) + exp_in,
+    }
+    return jwt.encode(
+        payload, private_key, algorithm="RS256", headers={"kid": kid}
+    ).decode()
+
+
+def test_jwks_store_caches_keys_and_tokens(rsa_key, jwks_stub):
+    store = JWKSKeyStore(JWKS_URL)
+    token = make_token(rsa_key)
+    kwargs = {"audience": "https://bookstore/api", "issuer": "https://auth.test/"}
+
+    assert store.decode(token, **kwargs)["sub"] == "user"
+    assert store.decode(token, **kwargs)["sub"] == "user"
+    assert store.decode(make_token(rsa_key, exp_in=60), **kwargs)["sub"] == "user"
+
+    assert len(jwks_stub.calls) == 1
+    assert store.stats["token_hits"] == 1
+    assert store.stats["key_hits"] == 2
+
+
+def test_jwks_store_unknown_kid_refresh_cooldown(rsa_key, jwks_stub):
+    store = JWKSKeyStore(JWKS_URL, refresh_cooldown=60)
+    kwargs = {"audience": "https://bookstore/api", "issuer": "https://auth.test/"}
+
+    for _ in range(3):
+        with pytest.raises(jwt.InvalidTokenError):
+            store.decode(make_token(rsa_key, kid="rotated"), **kwargs)
+
+    assert len(jwks_stub.calls) == 1
+    assert store.stats["key_misses"] == 3
+
+
+def test_jwks_store_fetches_outside_lock(rsa_key, jwks_stub, monkeypatch):
+    import threading
+
+    store = JWKSKeyStore(JWKS_URL, refresh_cooldown=0)
+    kwargs = {"audience": "https://bookstore/api", "issuer": "https://auth.test/"}
+    token = make_token(rsa_key)
+    assert store.decode(token, **kwargs)["sub"] == "user"
+
+    started, release = threading.Event(), threading.Event()
+    fetch = store._fetch
+
+    def slow_fetch():
+        started.set()
+        release.wait(5)
+        return fetch()
+
+    monkeypatch.setattr(store, "_fetch", slow_fetch)
+    forged = threading.Thread(target=store.get_key, args=("forged",), daemon=True)
+    forged.start()
+    assert started.wait(5)
+
+    # Cached tokens, known keys and the lock are all usable mid-fetch.
+    assert store.decode(token, **kwargs)["sub"] == "user"
+    assert store.decode(make_token(rsa_key, exp_in=60), **kwargs)["sub"] == "user"
+    assert forged.is_alive()
+    release.set()
+    forged.join(5)
+    assert len(jwks_stub.calls) == 2
+
+
+AUTH0_TOKEN_URL = f"{settings.AUTH0_BASE_URL}/oauth/token"
+
+
+def make_mono_key():
+    signing_key = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+    pub_key = base64.b64encode(signing_key.get_verifying_key().to_pem()).decode()
+    return signing_key, pub_key
+
+
+def mono_sign(signing_key, body):
+    signature = signing_key.sign(
+        body, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der
+    )
+    return base64.b64encode(signature).decode()
+
+
+@pytest.mark.django_db
+def test_webhook_verifier_caches_key(django_assert_num_queries):
+    signing_key, pub_key = make_mono_key()
+    MonoSettings.objects.create(public_key=pub_key)
+    verifier = WebhookVerifier()
+    body = b'{"invoiceId": "1"}'
+
+    assert verifier.verify(mono_sign(signing_key, body), body)
+    with django_assert_num_queries(0):
+        assert verifier.verify(mono_sign(signing_key, body), body)
+
+
+@pytest.mark.django_db
+@responses.activate
+def test_webhook_verifier_reloads_rotated_key():
+    _, old_key = make_mono_key()
+    new_signing_key, new_key = make_mono_key()
+    MonoSettings.objects.create(public_key=old_key)
+    responses.add(
+        responses.GET,
+        "https://api.monobank.ua/api/merchant/pubkey",
+        json={"key": new_key},
+    )
+    verifier = WebhookVerifier(reload_interval=60)
+    body = b'{"invoiceId": "1"}'
+
+    assert verifier.verify(mono_sign(new_signing_key, body), body)
+    assert MonoSettings.get_token() == new_key
+
+    assert not verifier.verify("bad", body)
+    assert len(responses.calls) == 1
+
+
+@pytest.mark.django_db
+@responses.activate
+def test_webhook_verifier_keeps_unchanged_key():
+    _, key = make_mono_key()
+    MonoSettings.objects.create(public_key=key)
+    responses.add(
+        responses.GET,
+        "https://api.monobank.ua/api/merchant/pubkey",
+        json={"key": key},
+    )
+    verifier = WebhookVerifier(reload_interval=0)
+    body = b'{"invoiceId": "1"}'
+
+    for _ in range(3):
+        assert not verifier.verify("bad", body)
+    assert len(responses.calls) == 3
+    assert MonoSettings.objects.count() == 1
+
+
+@pytest.fixture
+def locmem_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    local_cache.clear()
+    yield cache
+    cache.clear()
+    local_cache.clear()
+
+
+@pytest.fixture
+def rest_client(django_user_model):
+    client = APIClient()
+    client.force_authenticate(user=django_user_model.objects.create(username="t"))
+    return client
+
+
+@pytest.fixture
+def books():
+    author = Author.objects.create(name="author_1")
+    return [
+        Book.objects.create(title=f"book_{i}", author=author, genre="genre_1")
+        for i in range(3)
+    ]
+
+
+@pytest.mark.django_db
+def test_book_update_keeps_other_pages_cached(
+    locmem_cache, rest_client, books, django_assert_num_queries
+):
+    urls = [reverse("book", args=[book.id]) for book in books]
+    urls += [reverse("authors"), reverse("author", args=[books[0].author_id])]
+    for url in urls + [reverse("books")]:
+        assert rest_client.get(url).status_code == 200
+
+    response = rest_client.put(urls[0], {"price": 500}, format="json")
+    assert response.status_code == 200
+
+    with django_assert_num_queries(0):
+        for url in urls[1:]:
+            assert rest_client.get(url).status_code == 200
+
+    assert rest_client.get(urls[0]).json()["price"] == 500
+    assert rest_client.get(reverse("books")).json()["results"][0]["price"] == 500
+
+
+def test_bump_versions_never_reuses_evicted_stamps(locmem_cache, monkeypatch):
+    def incr(key, delta=1, version=None):
+        # Like django_bmemcached, create missing keys at 0.
+        value = locmem_cache.get(key, 0) + delta
+        locmem_cache.set(key, value, None)
+        return value
+
+    monkeypatch.setattr(locmem_cache, "incr", incr)
+    key = VERSION_KEY.format(BOOKS)
+    (before,), _ = get_stamps([BOOKS])
+    locmem_cache.delete(key)
+    bump_versions(BOOKS)
+    assert locmem_cache.get(key) >= before
+    bump_versions(BOOKS)
+    assert locmem_cache.get(key) > before
+
+
+@contextmanager
+def query_budget(budget):
+    with CaptureQueriesContext(connection) as ctx:
+        yield ctx
+    queries = "\n".join(query["sql"] for query in ctx.captured_queries)
+    assert len(ctx) <= budget, f"{len(ctx)} queries, budget {budget}:\n{queries}"
+
+
+@pytest.fixture
+def catalog():
+    authors = Author.objects.bulk_create(
+        [Author(name=f"author_{i}") for i in range(20)]
+    )
+    books = Book.objects.bulk_create(
+        [
+            Book(
+                title=f"book_{i}",
+                author=authors[i % 20],
+                genre="genre_1",
+                publication_date=date(2020, 1, 1) + timedelta(days=i // 10),
+            )
+            for i in range(40)
+        ]
+    )
+    for i in range(20):
+        order = Order.objects.create(total_price=1, invoice_id=f"inv_{i}")
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=order, book=book) for book in books[i : i + 3]]
+        )
+    return books
+
+
+READ_ENDPOINT_BUDGETS = [
+    ("/api/books", 2),
+    ("/api/books?limit=100", 2),
+    ("/api/books?title=book&author=author&genre=genre", 2),
+    ("/api/books?search=book_1&publication_date=2020-01-01", 3),
+    ("/api/books/{book}", 1),
+    ("/api/authors", 2),
+    ("/api/authors?name=author&limit=100", 2),
+    ("/api/authors/{author}", 1),
+    ("/api/orders/", 3),
+    ("/api/orders/?limit=100", 3),
+    ("/api/orders/{order}/", 2),
+    ("/api/orders/?status=success&created_at_after=2020-01-01T00:00:00Z", 3),
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("url, budget", READ_ENDPOINT_BUDGETS)
+def test_read_endpoint_query_budget(locmem_cache, catalog, url, budget):
+    Order.objects.filter(invoice_id__in=["inv_0", "inv_1"]).update(status="success")
+    client = APIClient()
+    url = url.format(
+        book=catalog[0].id,
+        author=catalog[0].author_id,
+        order=Order.objects.first().id,
+    )
+    with query_budget(budget):
+        response = client.get(url)
+    # Every filter matches some rows, so the budget covers the page path.
+    assert response.status_code == 200
+    assert response.json().get("results", True)
+
+
+def walk_cursor_pages(client, url):
+    rows = []
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        rows += response.json()["results"]
+        url = response.json()["next"]
+    return rows
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("ordering", ["", "price", "-publication_date", "title"])
+def test_books_cursor_pagination(locmem_cache, ordering):
+    author = Author.objects.create(name="author_1")
+    for i in range(23):
+        Book.objects.create(
+            title=f"book_{i % 5}",
+            author=author,
+            genre="genre_1",
+            price=i % 4,
+            publication_date=date(2000 + i % 3, 1, 1),
+        )
+    url = f"/api/books?cursor=&limit=5&ordering={ordering}"
+
+    rows = walk_cursor_pages(APIClient(), url)
+
+    field = ordering.lstrip("-") or "id"
+    expected = sorted(
+        Book.objects.values(field, "id"),
+        key=lambda row: (row[field], row["id"]),
+        reverse=ordering.startswith("-"),
+    )
+    assert [row["id"] for row in rows] == [row["id"] for row in expected]
+
+
+@pytest.mark.django_db
+def test_orders_cursor_pagination(locmem_cache, catalog):
+    rows = walk_cursor_pages(APIClient(), "/api/orders/?cursor=&limit=7")
+    assert [row["id"] for row in rows] == list(
+        Order.objects.order_by("-id").values_list("id", flat=True)
+    )
+
+
+@pytest.mark.django_db
+def test_cursor_pagination_rejects_bad_input(locmem_cache, books):
+    def cursor(ordering, value, id=1):
+        data = json.dumps({"o": ordering, "v": value, "id": id}).encode()
+        return base64.urlsafe_b64encode(data).decode()
+
+    client = APIClient()
+    assert client.get("/api/books?cursor=&ordering=genre").status_code == 400
+    assert client.get("/api/books?cursor=garbage").status_code == 404
+    for ordering, value in (
+        ("price", {"a": 1}),
+        ("price", [1]),
+        ("price", "cheap"),
+        ("title", None),
+        ("publication_date", "someday"),
+        ("publication_date", 5),
+    ):
+        url = f"/api/books?ordering={ordering}&cursor={cursor(ordering, value)}"
+        assert client.get(url).status_code == 404, url
+
+
+@pytest.mark.django_db
+def test_empty_pages_match_in_both_modes(locmem_cache, books):
+    # No matching rows is a 404, a page past the last row is empty.
+    client = APIClient()
+    for url in ("/api/books?title=missing", "/api/books?title=missing&cursor="):
+        response = client.get(url)
+        assert response.status_code == 404
+        assert response.json() == {"msg": "no books found by filters"}
+
+    last = base64.urlsafe_b64encode(b'{"o": "id", "v": 0, "id": 1000}').decode()
+    for url in ("/api/books?offset=10", f"/api/books?cursor={last}"):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json()["results"] == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("async_view", [False, True])
+def test_offset_pages_follow_ordering(locmem_cache, async_view):
+    author = Author.objects.create(name="author_1")
+    Book.objects.bulk_create(
+        Book(title=f"book_{price}", author=author, genre="genre_1", price=price)
+        for price in (5, 1, 3, 2, 4)
+    )
+
+    def prices(url):
+        if async_view:
+            request = AsyncRequestFactory().get(url)
+            response = async_to_sync(async_views.books)(request)
+        else:
+            response = APIClient().get(url)
+        assert response.status_code == 200
+        return [book["price"] for book in json.loads(response.content)["results"]]
+
+    assert prices("/api/books?ordering=price") == [1, 2, 3, 4, 5]
+    assert prices("/api/books?ordering=-price&limit=2&offset=1") == [4, 3]
+    assert prices("/api/books") == [5, 1, 3, 2, 4]
+    response = APIClient().get("/api/books?ordering=genre")
+    assert response.status_code == 400
+
+
+SEARCH_FILTERS = [
+    {"title": "potter"},
+    {"title": "Po"},
+    {"author": "rowl"},
+    {"genre": "fant", "title": "harry"},
+    {"search": "HARRY"},
+    {"search": "of the"},
+    {"author": "tolkien", "search": "ring"},
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("filters", SEARCH_FILTERS)
+def test_sqlite_search_matches_icontains(filters):
+    rowling = Author.objects.create(name="J. K. Rowling")
+    tolkien = Author.objects.create(name="J. R. R. Tolkien")
+    for title, author, genre in [
+        ("Harry Potter and the Goblet of Fire", rowling, "Fantasy"),
+        ("Harry Potter and the Order of the Phoenix", rowling, "Fantasy"),
+        ("The Fellowship of the Ring", tolkien, "Fantasy"),
+        ("The Children of Hurin", tolkien, "Mythopoeia"),
+        ("Poems", tolkien, "Poetry"),
+    ]:
+        Book.objects.create(title=title, author=author, genre=genre)
+
+    queryset = Book.objects.all()
+    expected = LikeSearchBackend().filter(queryset, **filters)
+    found = SQLiteSearchBackend().filter(queryset, **filters)
+    assert {book.id for book in found} == {book.id for book in expected}
+
+
+@pytest.mark.django_db
+def test_sqlite_search_index_follows_writes():
+    author = Author.objects.create(name="author_1")
+    book = Book.objects.create(title="Dune", author=author, genre="sf")
+    backend = SQLiteSearchBackend()
+
+    book.title = "Children of Dune"
+    book.save()
+    author.name = "Frank Herbert"
+    author.save()
+    assert list(backend.filter(Book.objects.all(), search="children")) == [book]
+    assert list(backend.filter(Book.objects.all(), author="herbert")) == [book]
+
+    book.delete()
+    assert not backend.filter(Book.objects.all(), search="dune").exists()
+
+
+@pytest.mark.django_db
+def test_import_books_csv(locmem_cache, rest_client, django_assert_max_num_queries):
+    Author.objects.create(name="author_1")
+    rows = ["title,author,genre,price,quantity,publication_date"]
+    rows += [f"book_{i},author_{i % 3},genre_1,{i},5,2020-01-01" for i in range(25)]
+    rows += ["bad,author_1,genre_1,-1,5,", ",author_1,genre_1,1,1,", "x,y,z,1,1,1-1-1"]
+
+    with django_assert_max_num_queries(20):
+        response = rest_client.post(
+            reverse("books_import"), "\n".join(rows), content_type="text/csv"
+        )
+
+    result = response.json()
+    assert response.status_code == 200
+    assert result["created"] == 25
+    assert [error["line"] for error in result["errors"]] == [27, 28, 29]
+    assert Author.objects.count() == 3
+    assert Book.objects.filter(author__name="author_1").count() == 8
+
+
+@pytest.mark.django_db
+def test_import_books_command_ndjson(tmp_path, locmem_cache):
+    path = tmp_path / "books.ndjson"
+    lines = [
+        json.dumps({"title": f"b{i}", "author": "a", "genre": "g"}) for i in range(7)
+    ]
+    path.write_text("\n".join(lines + ["not json", "[1]"]))
+    out, err = io.StringIO(), io.StringIO()
+
+    call_command("import_books", str(path), batch_size=3, stdout=out, stderr=err)
+
+    assert Book.objects.count() == 7
+    assert "Imported 7 books, rejected 2 lines" in out.getvalue()
+    assert "line 8: invalid json" in err.getvalue()
+
+
+@pytest.mark.django_db
+def test_import_books_with_authors_added_meanwhile(locmem_cache):
+    importer = BookImporter(batch_size=2)
+    author = Author.objects.create(name="Late Author")
+    lines = [
+        json.dumps({"title": f"b{i}", "author": name, "genre": "g"})
+        for i, name in enumerate(["late  author", "LATE AUTHOR", "new author"])
+    ]
+
+    assert importer.run(lines, "ndjson")["created"] == 3
+    assert Author.objects.count() == 2
+    assert Book.objects.filter(author=author).count() == 2
+
+
+@pytest.mark.django_db
+def test_failed_import_invalidates_committed_chunks(locmem_cache):
+    def lines():
+        for i in range(3):
+            yield json.dumps({"title": f"b{i}", "author": "a", "genre": "g"})
+        raise OSError("connection reset")
+
+    (books_before, authors_before), _ = get_stamps([BOOKS, AUTHORS])
+    with pytest.raises(OSError):
+        BookImporter(batch_size=2).run(lines(), "ndjson")
+
+    assert Book.objects.count() == 2
+    (books_after, authors_after), _ = get_stamps([BOOKS, AUTHORS])
+    assert books_after != books_before
+    assert authors_after != authors_before
+
+
+@pytest.mark.django_db
+def test_generate_books_and_orders():
+    out = io.StringIO()
+    call_command("generate_books", 60, authors=5, seed=1, batch_size=25, stdout=out)
+    call_command("generate_orders", 40, max_items=3, seed=1, batch_size=15, stdout=out)
+
+    assert Book.objects.count() == 60
+    assert Author.objects.count() == 5
+    assert Order.objects.values("invoice_id").distinct().count() == 40
+    for order in Order.objects.prefetch_related("orderitem_set__book"):
+        items = order.orderitem_set.all()
+        assert 1 <= len(items) <= 3
+        assert order.total_price == sum(i.book.price * i.quantity for i in items)
+        assert order.created_at.year == 2023
+
+
+MONO_INVOICE_URL = "https://api.monobank.ua/api/merchant/invoice/create"
+
+
+@pytest.mark.django_db
+@responses.activate
+def test_create_order_reserves_stock(locmem_cache, books):
+    responses.add(
+        responses.POST,
+        MONO_INVOICE_URL,
+        json={"invoiceId": "inv_1", "pageUrl": "https://pay.test/inv_1"},
+    )
+    order_data = {
+        "order": [
+            {"book_id": books[0].id, "quantity": 1},
+            {"book_id": books[1].id, "quantity": 1},
+            {"book_id": books[0].id, "quantity": 0},
+        ]
+    }
+    client = APIClient()
+    assert client.post("/api/order/", order_data, format="json").status_code == 400
+
+    order_data["order"].pop()
+    with query_budget(8):
+        response = client.post("/api/order/", order_data, format="json")
+
+    assert response.json()["url"] == "https://pay.test/inv_1"
+    order = Order.objects.get(id=response.json()["id"])
+    assert order.invoice_id == "inv_1"
+    assert order.total_price == books[0].price + books[1].price
+    assert order.orderitem_set.count() == 2
+    assert Book.objects.get(id=books[0].id).quantity == 0
+
+    response = client.post("/api/order/", order_data, format="json")
+    assert response.status_code == 400
+    assert response.json() == {"error": "available quantity = 0"}
+    assert Order.objects.count() == 1
+
+
+@pytest.mark.django_db
+@responses.activate
+def test_create_order_releases_stock_on_monobank_error(locmem_cache, books):
+    responses.add(responses.POST, MONO_INVOICE_URL, status=500)
+    order_data = {"order": [{"book_id": books[0].id, "quantity": 1}]}
+    client = APIClient()
+    client.raise_request_exception = False
+
+    assert client.post("/api/order/", order_data, format="json").status_code == 500
+    assert Book.objects.get(id=books[0].id).quantity == 1
+    assert Order.objects.get().status == "failure"
+
+    order_data = {"order": [{"book_id": 0, "quantity": 1}]}
+    assert client.post("/api/order/", order_data, format="json").status_code == 404
+
+
+@pytest.fixture(autouse=True)
+def outbound_clients():
+    yield
+    reset_clients()
+
+
+@responses.activate
+def test_outbound_client_retries_idempotent_requests():
+    client = OutboundClient("stub", "http://stub.test/", backoff=0)
+    responses.add(responses.GET, "http://stub.test/keys", status=503)
+    responses.add(responses.GET, "http://stub.test/keys", json={"ok": True})
+    responses.add(responses.POST, "http://stub.test/invoice", status=503)
+
+    assert client.get("/keys").json() == {"ok": True}
+    assert client.post("invoice").status_code == 503
+    assert client.stats["requests"] == 3
+    assert client.stats["retries"] == 1
+    assert client.stats["errors"] == 2
+
+
+@responses.activate
+def test_outbound_client_circuit_breaker():
+    client = OutboundClient(
+        "stub", "http://stub.test", retries=0, failure_threshold=2, reset_timeout=60
+    )
+    responses.add(
+        responses.GET, "http://stub.test/", body=requests.ConnectionError("down")
+    )
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.get("/")
+    with pytest.raises(CircuitOpenError):
+        client.get("/")
+
+    assert len(responses.calls) == 2
+    assert client.breaker.state == "open"
+    client.breaker.opened_at -= 60
+    assert client.breaker.state == "half-open"
+    with pytest.raises(requests.ConnectionError):
+        client.get("/")
+    assert client.breaker.state == "open"
+
+
+@responses.activate
+def test_circuit_breaker_trial_ends_on_any_error():
+    client = OutboundClient(
+        "stub", "http://stub.test", retries=0, failure_threshold=1, reset_timeout=60
+    )
+    responses.add(responses.GET, "http://stub.test/", body=ValueError("bad url"))
+    client.breaker.record_failure()
+    client.breaker.opened_at -= 60
+
+    with pytest.raises(ValueError):
+        client.get("/")
+    assert client.breaker.state == "open"
+    client.breaker.opened_at -= 60
+    responses.replace(responses.GET, "http://stub.test/", status=204)
+    assert client.get("/").status_code == 204
+    assert client.breaker.state == "closed"
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.django_db
+@responses.activate
+def test_metrics_endpoint(locmem_cache, books, rest_client):
+    request_labels = {"view": "books", "method": "GET", "status": "200"}
+    requests_before = sample(
+        "bookstore_request_duration_seconds_count", **request_labels
+    )
+    hits_before = sample("bookstore_cache_page_total", view="books", result="hit")
+    misses_before = sample("bookstore_cache_page_total", view="books", result="miss")
+    queries_before = sample("bookstore_db_queries_per_request_sum", view="books")
+
+    for _ in range(2):
+        assert rest_client.get(reverse("books")).status_code == 200
+
+    responses.add(responses.GET, "http://upstream.test/ping", status=204)
+    OutboundClient("metrics_test", "http://upstream.test").get("/ping")
+
+    assert (
+        sample("bookstore_request_duration_seconds_count", **request_labels)
+        == requests_before + 2
+    )
+    assert sample("bookstore_cache_page_total", view="books", result="miss") == (
+        misses_before + 1
+    )
+    assert sample("bookstore_cache_page_total", view="books", result="hit") == (
+        hits_before + 1
+    )
+    assert sample("bookstore_db_queries_per_request_sum", view="books") > queries_before
+    assert (
+        sample(
+            "bookstore_outbound_request_duration_seconds_count",
+            upstream="metrics_test",
+            status="204",
+        )
+        == 1
+    )
+
+    response = rest_client.get("/metrics")
+    assert response.status_code == 200
+    assert b'bookstore_request_duration_seconds_count{method="GET"' in response.content
+
+
+def test_jwks_store_refreshes_stale_keys_in_background(rsa_key, jwks_stub, monkeypatch):
+    store = JWKSKeyStore(JWKS_URL, ttl=0, refresh_cooldown=0, token_cache_size=0)
+    kwargs = {"audience": "https://bookstore/api", "issuer": "https://auth.test/"}
+    assert store.decode(make_token(rsa_key), **kwargs)["sub"] == "user"
+
+    threads = []
+    refresh_in_background = store.refresh_in_background
+    monkeypatch.setattr(
+        store,
+        "refresh_in_background",
+        lambda: threads.append(refresh_in_background()),
+    )
+    assert store.decode(make_token(rsa_key), **kwargs)["sub"] == "user"
+
+    assert len(threads) == 1
+    threads[0].join()
+    assert len(jwks_stub.calls) == 2
+
+
+@pytest.mark.django_db
+def test_metrics_count_queries_under_asgi(locmem_cache, books):
+    # The ASGI handler runs the sync middleware and view on another thread.
+    queries_before = sample("bookstore_db_queries_per_request_sum", view="books")
+
+    async def get():
+        return await AsyncClient().get(reverse("books"))
+
+    response = async_to_sync(get)()
+
+    assert response.status_code == 200
+    assert sample("bookstore_db_queries_per_request_sum", view="books") > (
+        queries_before
+    )
+
+
+ASYNC_CATALOG_URLS = [
+    ("books", "/api/books", {}),
+    ("books", "/api/books?title=book_1&limit=5&offset=2", {}),
+    ("books", "/api/books?cursor=&ordering=-title&limit=3", {}),
+    ("books", "/api/books?ordering=genre&cursor=", {}),
+    ("books", "/api/books?title=missing", {}),
+    ("books", "/api/books?bad=1", {}),
+    ("books", "/api/books?ids={book}", {}),
+    ("books", "/api/books?ids=1,x", {}),
+    ("book", "/api/books/{book}", {"id": "{book}"}),
+    ("book", "/api/books/0", {"id": 0}),
+    ("authors", "/api/authors?name=author_1", {}),
+    ("author", "/api/authors/{author}", {"id": "{author}"}),
+    ("author", "/api/authors/0", {"id": 0}),
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("view, url, kwargs", ASYNC_CATALOG_URLS)
+def test_async_catalog_matches_sync_views(locmem_cache, catalog, view, url, kwargs):
+    ids = {"book": catalog[0].id, "author": catalog[0].author_id}
+    url = url.format(**ids)
+    kwargs = {name: int(str(value).format(**ids)) for name, value in kwargs.items()}
+    expected = APIClient().get(url)
+    async_view = getattr(async_views, view)
+
+    with query_budget(3):
+        response = async_to_sync(async_view)(AsyncRequestFactory().get(url), **kwargs)
+    assert response.status_code == expected.status_code
+    assert response["Content-Type"] == expected["Content-Type"]
+    assert response.content == expected.content
+    assert response.get("ETag") == expected.get("ETag")
+
+    if response.status_code == 200:
+        with query_budget(0):
+            cached = async_to_sync(async_view)(AsyncRequestFactory().get(url), **kwargs)
+        assert cached.content == expected.content
+
+
+def read_stream(response):
+    return b"".join(response.streaming_content).decode()
+
+
+@pytest.mark.django_db
+def test_books_export(settings, catalog):
+    settings.EXPORT_CHUNK_SIZE = 7
+    client = APIClient()
+
+    response = client.get("/api/books/export?title=book_1&author=author_1")
+    assert response["Content-Type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in read_stream(response).splitlines()]
+    expected = Book.objects.filter(
+        title__icontains="book_1", author__name__icontains="author_1"
+    )
+    assert [row["id"] for row in rows] == sorted(book.id for book in expected)
+    assert rows[0]["author"] == "author_1"
+
+    watermark = rows[-1]["updated_at"]
+    Book.objects.filter(id=catalog[0].id).update(
+        price=2, updated_at=timezone.now() + timedelta(seconds=1)
+    )
+    response = client.get("/api/books/export", {"updated_since": watermark})
+    ids = [json.loads(line)["id"] for line in read_stream(response).splitlines()]
+    assert ids[-1] == catalog[0].id
+
+    response = client.get("/api/books/export?format=csv&genre=genre_1")
+    lines = read_stream(response).splitlines()
+    assert (
+        lines[0] == "id,title,genre,author,price,quantity,publication_date,updated_at"
+    )
+    assert len(lines) == 41
+
+    assert client.get("/api/books/export?format=xml").status_code == 400
+    assert client.get("/api/books/export?updated_since=soon").status_code == 400
+    assert client.get("/api/books/export?limit=1").status_code == 400
+
+
+@pytest.mark.django_db
+def test_orders_export_queries_per_chunk(settings, catalog):
+    settings.EXPORT_CHUNK_SIZE = 5
+    orders = Order.objects.count()
+
+    with query_budget(2 * (orders // 5 + 1)):
+        response = APIClient().get("/api/orders/export?format=csv")
+        lines = read_stream(response).splitlines()
+
+    assert response["Content-Type"] == "text/csv"
+    assert lines[0] == "id,total_price,created_at,updated_at,invoice_id,status,books"
+    assert len(lines) == orders + 1
+    first = Order.objects.order_by("updated_at", "id").first()
+    books = ";".join(
+        str(id)
+        for id in first.books.order_by("orderitem__id").values_list("id", flat=True)
+    )
+    assert lines[1].startswith(f"{first.id},") and lines[1].endswith(books)
+
+
+@pytest.mark.django_db
+def test_orders_embed_line_items(catalog):
+    client = APIClient()
+    Order.objects.filter(invoice_id__in=["inv_0", "inv_1"]).update(status="success")
+    Order.objects.filter(invoice_id="inv_1").update(
+        created_at=timezone.make_aware(datetime(2020, 1, 1))
+    )
+    OrderItem.objects.filter(order__invoice_id="inv_0").update(quantity=2, price=300)
+
+    with query_budget(3):
+        results = client.get("/api/orders/?status=success").json()["results"]
+    assert [order["invoice_id"] for order in results] == ["inv_1", "inv_0"]
+    assert results[1]["books"] == [book.id for book in catalog[:3]]
+    assert results[1]["items"][0] == {
+        "book_id": catalog[0].id,
+        "title": "book_0",
+        "quantity": 2,
+        "price": 300,
+    }
+
+    response = client.get(
+        "/api/orders/?status=success&created_at_before=2021-01-01T00:00:00Z"
+    )
+    assert [order["invoice_id"] for order in response.json()["results"]] == ["inv_1"]
+    assert client.get("/api/orders/?created_at_after=soon").status_code == 400
+
+    response = client.get("/api/orders/export?status=success&format=csv")
+    assert len(read_stream(response).splitlines()) == 3
+
+
+def post_mono_callback(order, status, reference=None, seconds=None):
+    # Monobank stamps every status change; a redelivery repeats the stamp.
+    modified = order.created_at + timedelta(
+        seconds=STATUS_RANKS[status] if seconds is None else seconds
+    )
+    body = {
+        "invoiceId": order.invoice_id,
+        "status": status,
+        "amount": 1,
+        "ccy": 980,
+        "reference": reference or str(order.id),
+        "modifiedDate": modified.isoformat(),
+    }
+    response = APIClient().post("/api/monobank/callback", body, format="json")
+    assert response.status_code == 200
+
+
+@pytest.fixture
+def paid_orders(catalog, monkeypatch):
+    """Marks two catalog orders paid through the Monobank callback."""
+    monkeypatch.setattr("api.views.webhook_verifier.verify", lambda *args: True)
+    orders = list(Order.objects.order_by("id")[:2])
+    OrderItem.objects.filter(order=orders[0]).update(quantity=2, price=100)
+    OrderItem.objects.filter(order=orders[1]).update(price=None)
+    Book.objects.filter(id__in=[book.id for book in catalog[1:4]]).update(price=50)
+
+    def callback(order, status):
+        post_mono_callback(order, status)
+        call_command("process_mono_events", stdout=io.StringIO())
+
+    for order in orders + orders[:1]:
+        callback(order, "success")
+    return orders, callback
+
+
+@pytest.mark.django_db
+def test_stats_from_rollups(paid_orders, rest_client, catalog):
+    orders, callback = paid_orders
+    day = orders[0].created_at.date().isoformat()
+
+    with query_budget(1):
+        response = rest_client.get(f"/api/stats?from={day}&to={day}")
+    assert response.json()["results"] == [{"day": day, "revenue": 750, "units": 9}]
+
+    with query_budget(2):
+        response = rest_client.get(f"/api/stats?by=book&from={day}&to={day}&limit=2")
+    assert response.json()["results"] == [
+        {"book_id": catalog[1].id, "title": "book_1", "revenue": 250, "units": 3},
+        {"book_id": catalog[2].id, "title": "book_2", "revenue": 250, "units": 3},
+    ]
+    response = rest_client.get(f"/api/stats?by=genre&from={day}&to={day}")
+    assert response.json()["results"] == [
+        {"genre": "genre_1", "revenue": 750, "units": 9}
+    ]
+
+    callback(orders[0], "reversed")
+    response = rest_client.get(f"/api/stats?by=author&from={day}&to={day}&limit=1")
+    assert response.json()["results"] == [
+        {
+            "author_id": catalog[1].author_id,
+            "author": "author_1",
+            "revenue": 50,
+            "units": 1,
+        }
+    ]
+
+    incremental = sorted(SalesRollup.objects.values_list("dimension", "key", "revenue"))
+    call_command("rebuild_rollups", batch_size=1, stdout=io.StringIO())
+    assert sorted(SalesRollup.objects.values_list("dimension", "key", "revenue")) == [
+        row for row in incremental if row[2]
+    ]
+
+    assert APIClient().get("/api/stats").status_code == 401
+    assert rest_client.get("/api/stats?by=genre&from=2020-13-01").status_code == 400
+    assert rest_client.get("/api/stats?by=isbn").status_code == 400
+    for limit in ("0", "-1", "x"):
+        assert rest_client.get(f"/api/stats?limit={limit}").status_code == 400
+
+
+def full_scans(sql):
+    """Plan steps of ``sql`` that read a whole table instead of an index."""
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(f"EXPLAIN {sql}")
+            return [row[0] for row in cursor.fetchall() if "Seq Scan" in row[0]]
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        # FTS5 lookups show up as a scan of the virtual table.
+        return [
+            row[-1]
+            for row in cursor.fetchall()
+            if row[-1].startswith("SCAN") and "VIRTUAL TABLE" not in row[-1]
+        ]
+
+
+@contextmanager
+def index_scans_only():
+    """Fails if a filtered query run inside the block scans a whole table."""
+    with CaptureQueriesContext(connection) as ctx:
+        yield ctx
+    for query in ctx.captured_queries:
+        sql = query["sql"]
+        if " WHERE " in sql and not sql.startswith(("INSERT", "SAVEPOINT")):
+            scans = full_scans(sql)
+            assert not scans, f"{scans}:\n{sql}"
+
+
+@pytest.fixture
+def seeded_books():
+    """Generated catalog with planner statistics, plus filter values from it."""
+    call_command("generate_books", 500, authors=50, seed=1, stdout=io.StringIO())
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    book = Book.objects.select_related("author").order_by("id")[100]
+    # Terms of 3+ characters; shorter ones fall back to LIKE on SQLite.
+    return {
+        "title": max(book.title.split(), key=len),
+        "author": max(book.author.name.split(), key=len),
+        "genre": book.genre[:4],
+        "publication_date": book.publication_date.isoformat(),
+        "search": max(book.title.split(), key=len),
+    }
+
+
+BOOK_FILTER_COMBINATIONS = [
+    combination
+    for size in range(1, 6)
+    for combination in itertools.combinations(
+        ["title", "author", "genre", "publication_date", "search"], size
+    )
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("filters", BOOK_FILTER_COMBINATIONS, ids="&".join)
+@pytest.mark.parametrize("ordering", ["", "price"])
+def test_book_filters_use_indexes(locmem_cache, seeded_books, filters, ordering):
+    params = {name: seeded_books[name] for name in filters}
+    if ordering:
+        params["ordering"] = ordering
+    with index_scans_only():
+        response = APIClient().get("/api/books", params)
+    assert response.status_code == 200
+    assert response.json()["results"]
+
+
+@pytest.mark.django_db
+def test_order_callback_uses_indexes(paid_orders):
+    orders, callback = paid_orders
+    # A drained inbox, processed a few events at a time.
+    now = timezone.now()
+    MonoEvent.objects.bulk_create(
+        MonoEvent(
+            invoice_id=f"old_{i}",
+            modified_date=now,
+            reference="0",
+            status="success",
+            payload={},
+            processed_at=now - timedelta(seconds=i // 3),
+        )
+        for i in range(300)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    with index_scans_only():
+        callback(orders[1], "reversed")
+        callback(orders[0], "reversed")
+
+
+@pytest.mark.django_db
+def test_author_names_are_unique_ignoring_case(locmem_cache, rest_client, books):
+    author = books[0].author
+    body = {
+        "title": "book_4",
+        "author": "  AUTHOR_1 ",
+        "genre": "genre_1",
+        "price": 1,
+        "quantity": 1,
+    }
+    with index_scans_only():
+        response = rest_client.post("/api/books", body, format="json")
+    assert response.status_code == 201
+    assert Author.objects.count() == 1
+    assert Book.objects.get(title="book_4").author == author
+
+    response = rest_client.put(
+        f"/api/books/{books[1].id}", {"author": "new  author"}, format="json"
+    )
+    assert response.status_code == 200
+    assert Author.objects.get_or_create_by_name("NEW AUTHOR")[0].name == "new author"
+    assert Author.objects.count() == 2
+
+
+@pytest.fixture
+def auth0_token_stub(locmem_cache):
+    token_manager.clear()
+    calls = []
+
+    def exchange(request):
+        calls.append(request)
+        time.sleep(0.05)
+        body = {"access_token": f"token_{len(calls)}", "expires_in": 3600}
+        return 200, {}, json.dumps(body)
+
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback(responses.POST, AUTH0_TOKEN_URL, callback=exchange)
+        yield calls
+    token_manager.clear()
+
+
+def test_access_token_manager_single_flight(auth0_token_stub, monkeypatch):
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        tokens = set(pool.map(lambda _: token_manager.get(), range(20)))
+    assert tokens == {"token_1"}
+    assert len(auth0_token_stub) == 1
+
+    # Another process finds the token in the shared cache.
+    other = AccessTokenManager(margin=60)
+    assert other.get() == "token_1"
+    assert other.stats == {"memory_hits": 0, "cache_hits": 1, "refreshes": 0}
+
+    # Refreshed once it is within the margin of expiring.
+    monkeypatch.setattr(time, "time", lambda: token_manager._expires_at - 30)
+    assert token_manager.get() == "token_2"
+    assert len(auth0_token_stub) == 2
+
+
+@pytest.mark.django_db
+def test_token_view_uses_cached_token(auth0_token_stub, django_assert_num_queries):
+    client = Client()
+    session = client.session
+    session["user"] = {"userinfo": {"sub": "auth0|1"}}
+    session.save()
+
+    assert client.get(reverse("index")).status_code == 200
+    assert Token.objects.get(sub="auth0|1").token == "token_1"
+    assert client.get(reverse("index")).status_code == 200
+    assert Token.objects.count() == 1
+
+    # Only the session is read once the subject and token are cached.
+    with django_assert_num_queries(1):
+        response = client.get(reverse("token"))
+    assert response.json() == {"access_token": "token_1"}
+    assert len(auth0_token_stub) == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("async_catalog", [False, True])
+def test_catalog_conditional_get(locmem_cache, rest_client, books, async_catalog):
+    if async_catalog:
+        views = {"books": async_views.books, "book": async_views.book}
+
+        def get(name, url, **headers):
+            request = AsyncRequestFactory().get(url, headers=headers)
+            kwargs = {"id": books[0].id} if name == "book" else {}
+            return async_to_sync(views[name])(request, **kwargs)
+
+    else:
+
+        def get(name, url, **headers):
+            return APIClient().get(url, headers=headers)
+
+    pages = {"books": reverse("books"), "book": reverse("book", args=[books[0].id])}
+    for name, url in pages.items():
+        response = get(name, url)
+        assert response.status_code == 200
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+
+        with query_budget(0):
+            response = get(name, url, if_none_match=etag)
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response["ETag"] == etag
+        response = get(name, url, if_modified_since=last_modified)
+        assert response.status_code == 304
+        response = get(name, f"{url}?limit=1", if_none_match=etag)
+        assert response.status_code != 304
+
+    etag = get("book", pages["book"])["ETag"]
+    time.sleep(1)
+    assert (
+        rest_client.put(pages["book"], {"price": 5}, format="json").status_code == 200
+    )
+    response = get("book", pages["book"], if_none_match=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+    assert json.loads(response.content)["price"] == 5
+    response = get("books", pages["books"], if_modified_since=last_modified)
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_mono_callbacks_apply_forward_only(paid_orders, django_assert_num_queries):
+    orders, callback = paid_orders
+    order = orders[1]
+    revenue = SalesRollup.objects.get(dimension="day", period="day").revenue
+
+    # Late, repeated and mismatched callbacks are queued, then dropped.
+    with django_assert_num_queries(1):
+        post_mono_callback(order, "processing")
+    post_mono_callback(order, "created")
+    post_mono_callback(order, "success")
+    post_mono_callback(order, "reversed", reference=str(orders[0].id), seconds=9)
+    assert MonoEvent.objects.filter(processed_at=None).count() == 3
+    call_command("process_mono_events", stdout=io.StringIO())
+    order.refresh_from_db()
+    assert order.status == "success"
+    assert SalesRollup.objects.get(dimension="day", period="day").revenue == revenue
+
+    # Out of order within one batch: the furthest status wins.
+    post_mono_callback(orders[0], "reversed")
+    post_mono_callback(orders[0], "hold")
+    post_mono_callback(order, "reversed")
+    out = io.StringIO()
+    # One batch: claim events, lock orders, one bulk UPDATE, one rollup
+    # read and upsert, mark events; then the empty poll that ends the drain.
+    with django_assert_num_queries(11):
+        call_command("process_mono_events", batch_size=10, stdout=out)
+    assert "Processed 3 events, updated 2 orders" in out.getvalue()
+    assert set(
+        Order.objects.filter(id__in=[orders[0].id, order.id]).values_list(
+            "status", flat=True
+        )
+    ) == {"reversed"}
+    assert SalesRollup.objects.get(dimension="day", period="day").revenue == 0
+    assert MonoEvent.objects.filter(processed_at=None).count() == 0
+
+
+@pytest.mark.django_db
+def test_mono_callback_waits_for_invoice_id(paid_orders):
+    orders = paid_orders[0]
+    # The callback arrives before create_order stores the invoice id.
+    Order.objects.filter(id__in=[order.id for order in orders]).update(invoice_id=None)
+    for order in orders:
+        post_mono_callback(order, "reversed")
+    MonoEvent.objects.filter(reference=str(orders[0].id)).update(
+        received_at=timezone.now() - timedelta(seconds=601)
+    )
+    call_command("process_mono_events", stdout=io.StringIO())
+    pending = MonoEvent.objects.filter(processed_at=None)
+    assert list(pending.values_list("reference", flat=True)) == [str(orders[1].id)]
+
+    for order in orders:
+        Order.objects.filter(id=order.id).update(invoice_id=order.invoice_id)
+    call_command("process_mono_events", stdout=io.StringIO())
+    assert not pending.exists()
+    assert list(
+        Order.objects.filter(id__in=[order.id for order in orders])
+        .order_by("id")
+        .values_list("status", flat=True)
+    ) == ["success", "reversed"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/books?limit=100",
+        "/api/books?cursor=&ordering=-publication_date&limit=3",
+        "/api/authors?limit=100",
+        "/api/authors?cursor=&limit=2",
+    ],
+)
+def test_list_fast_path_matches_drf_serializers(locmem_cache, url):
+    odd = "".join(map(chr, range(32))) + '"\\/\u2028\u2029\x7fé€😀</script>'
+    authors = Author.objects.bulk_create(
+        [Author(name=odd), Author(name="author_2"), Author(name="ab")]
+    )
+    Book.objects.bulk_create(
+        Book(title=f"{odd}{i}", author=authors[i % 3], genre=odd, price=i)
+        for i in range(5)
+    )
+    model, serializer = (
+        (Book, BookSerializer) if "books" in url else (Author, AuthorSerializer)
+    )
+    response = APIClient().get(url)
+    view = BooksView if model is Book else AuthorsView
+    paginator = view.pagination_class()
+    request = Request(APIRequestFactory().get(url))
+    page = paginator.paginate_queryset(model.objects.order_by("id"), request, view=view)
+    expected = paginator.get_paginated_data(serializer(page, many=True).data)
+
+    assert response.content == JSONRenderer().render(expected)
+
+
+class SharedCacheSpy:
+    def __init__(self, cache, monkeypatch):
+        self.calls = 0
+        for name in ("get", "get_many", "aget", "aget_many"):
+            monkeypatch.setattr(cache, name, self.count(getattr(cache, name)))
+
+    def count(self, method):
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            return method(*args, **kwargs)
+
+        return wrapper
+
+
+@pytest.mark.django_db
+def test_local_cache_tier(locmem_cache, rest_client, books, monkeypatch, settings):
+    def tier(kind, tier, result):
+        return sample("bookstore_cache_tier_total", kind=kind, tier=tier, result=result)
+
+    url = reverse("book", args=[books[0].id])
+    assert rest_client.get(url).status_code == 200
+    local_hits = tier("page", "local", "hit")
+    shared = SharedCacheSpy(locmem_cache, monkeypatch)
+
+    with query_budget(0):
+        for _ in range(5):
+            response = rest_client.get(url)
+            assert response.status_code == 200
+            assert response.json()["id"] == books[0].id
+    assert shared.calls == 0
+    assert tier("page", "local", "hit") == local_hits + 5
+
+    # A write in this process is visible at once, other processes notice it
+    # once their stamps expire.
+    settings.LOCAL_CACHE_STAMP_TIMEOUT = 0.2
+    assert rest_client.put(url, {"price": 700}, format="json").status_code == 200
+    assert rest_client.get(url).json()["price"] == 700
+    Book.objects.filter(id=books[0].id).update(price=800)
+    locmem_cache.incr(VERSION_KEY.format(BOOK.format(id=books[0].id)))
+    assert rest_client.get(url).json()["price"] == 700
+    time.sleep(0.2)
+    assert rest_client.get(url).json()["price"] == 800
+    assert tier("stamp", "shared", "hit") > 0
+
+    small = type(local_cache)(max_size=150)
+    small.set("a", "x" * 40, 60)
+    small.set("b", "y" * 40, 60)
+    assert small.get("a") is not None
+    small.set("c", "z" * 40, 60)
+    assert small.get_many(["a", "b", "c"]).keys() == {"a", "c"}
+    small.set("d", "big" * 100, 60)
+    assert small.get("d") is None
+    small.set("e", 1, 0)
+    assert small.get("e") is None
+
+
+@pytest.mark.parametrize("async_view", [False, True])
+def test_page_cache_single_flight(locmem_cache, settings, monkeypatch, async_view):
+    settings.CACHE_PAGE_JITTER = 0
+    builds = []
+
+    if async_view:
+
+        @async_versioned_cache_page(60, BOOKS)
+        async def view(request):
+            builds.append(request)
+            await asyncio.sleep(0.1)
+            return HttpResponse(f"build {len(builds)}")
+
+        async def gather(count):
+            requests = [AsyncRequestFactory().get("/books") for _ in range(count)]
+            return await asyncio.gather(*map(view, requests))
+
+        def get_all(count=100):
+            return async_to_sync(gather)(count)
+
+    else:
+
+        @versioned_cache_page(60, BOOKS)
+        def view(request):
+            builds.append(request)
+            time.sleep(0.1)
+            return HttpResponse(f"build {len(builds)}")
+
+        def get_all(count=100):
+            with ThreadPoolExecutor(count) as pool:
+                requests = [RequestFactory().get("/books") for _ in range(count)]
+                return list(pool.map(view, requests))
+
+    responses = get_all()
+    assert len(builds) == 1
+    assert {response.content for response in responses} == {b"build 1"}
+    assert all(response["Cache-Control"] == "max-age=60" for response in responses)
+
+    # Once the page expires, one request rebuilds it and the rest get the
+    # expired page instead of waiting. Another process has no local copy.
+    local_cache.clear()
+    now = time.time() + 61
+    monkeypatch.setattr(time, "time", lambda: now)
+    stale = sample("bookstore_cache_page_total", view="unmatched", result="stale")
+    responses = get_all()
+    assert len(builds) == 2
+    contents = [response.content for response in responses]
+    assert contents.count(b"build 2") == 1
+    assert contents.count(b"build 1") == 99
+    assert (
+        sample("bookstore_cache_page_total", view="unmatched", result="stale")
+        == stale + 99
+    )
+    local_cache.clear()
+    assert get_all(1)[0].content == b"build 2"
+    assert len(builds) == 2
+
+
+@pytest.mark.parametrize("async_view", [False, True])
+def test_page_cache_releases_lock_when_view_raises(locmem_cache, settings, async_view):
+    settings.CACHE_PAGE_LOCK_TIMEOUT = 5
+    calls = []
+
+    if async_view:
+
+        @async_versioned_cache_page(60, BOOKS)
+        async def view(request):
+            calls.append(request)
+            raise ValueError("bad cursor")
+
+        def get():
+            return async_to_sync(view)(AsyncRequestFactory().get("/books"))
+
+    else:
+
+        @versioned_cache_page(60, BOOKS)
+        def view(request):
+            calls.append(request)
+            raise ValueError("bad cursor")
+
+        def get():
+            return view(RequestFactory().get("/books"))
+
+    started = time.perf_counter()
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            get()
+    assert len(calls) == 2
+    assert time.perf_counter() - started < 1
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    # A second connection to the test database stands in for the replica.
+    monkeypatch.setitem(
+        connections.settings, "replica", connections["default"].settings_dict
+    )
+    yield connections["replica"]
+    connections["replica"].close()
+    del connections["replica"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_replica_reads_with_sticky_primary(
+    locmem_cache, replica, rest_client, catalog, settings
+):
+    def databases(client, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as primary:
+            with CaptureQueriesContext(replica) as replicated:
+                response = getattr(client, method)(url, **kwargs)
+        assert response.status_code == 200
+        used = {"primary": primary, "replica": replicated}
+        return {alias for alias, queries in used.items() if queries}
+
+    settings.REPLICA_STICKY_SECONDS = 60
+    assert databases(APIClient(), "get", "/api/orders/") == {"replica"}
+
+    book = f"/api/books/{catalog[0].id}"
+    assert databases(rest_client, "put", book, data={"price": 9}, format="json") == {
+        "primary"
+    }
+    assert rest_client.cookies["primary_reads"]["max-age"] == 60
+
+    # The writer stays on the primary, other clients do not.
+    assert databases(rest_client, "get", "/api/orders/") == {"primary"}
+    assert databases(APIClient(), "get", "/api/orders/") == {"replica"}
+    # Pages of just changed resources are built from the primary.
+    assert databases(APIClient(), "get", "/api/books") == {"primary"}
+    settings.REPLICA_STICKY_SECONDS = 0
+    assert databases(APIClient(), "get", "/api/books?limit=5") == {"replica"}
+    assert databases(APIClient(), "get", "/api/authors") == {"replica"}
+
+
+@pytest.mark.django_db
+def test_books_multi_get(locmem_cache, rest_client, catalog, settings):
+    ids = [catalog[2].id, 0, catalog[0].id, catalog[1].id]
+    url = "/api/books?ids=" + ",".join(map(str, ids + [catalog[2].id]))
+    with query_budget(1):
+        response = APIClient().get(url)
+    assert response.status_code == 200
+    expected = [BookSerializer(catalog[i]).data for i in (2, 0, 1)]
+    assert response.json() == {"results": expected, "not_found": [0]}
+
+    # Found books are cached, only the missing id is looked up again.
+    with query_budget(1) as queries:
+        assert APIClient().get(url).json()["results"] == expected
+    assert "IN (0)" in queries.captured_queries[0]["sql"]
+
+    rest_client.put(f"/api/books/{catalog[0].id}", {"price": 42}, format="json")
+    with query_budget(1) as queries:
+        results = APIClient().get(url).json()["results"]
+    assert [book["price"] for book in results] == [1, 42, 1]
+    assert f"IN (0, {catalog[0].id})" in queries.captured_queries[0]["sql"]
+
+    settings.BOOKS_BULK_LIMIT = 3
+    for url, error in (
+        ("/api/books?ids=1,x", "ids should be comma separated integers"),
+        ("/api/books?ids=1,2,3,4", "at most 3 ids"),
+        ("/api/books?ids=1&title=a", "invalid query params"),
+    ):
+        response = APIClient().get(url)
+        assert response.status_code == 400
+        assert response.json() == {"error": error}
+
+
+def spy_cache_writes(cache, monkeypatch, names):
+    """Records ``(method, key or number of keys)`` for the ``names`` calls."""
+    writes = []
+
+    def spy(name):
+        method = getattr(cache, name)
+
+        def wrapper(data, *args, **kwargs):
+            writes.append((name, len(data) if name == "set_many" else data))
+            return method(data, *args, **kwargs)
+
+        return wrapper
+
+    for name in names:
+        monkeypatch.setattr(cache, name, spy(name))
+    return writes
+
+
+@pytest.mark.django_db
+def test_cold_row_stamps_are_seeded_in_one_write(locmem_cache, catalog, monkeypatch):
+    writes = spy_cache_writes(locmem_cache, monkeypatch, ("add", "set_many"))
+    ids = ",".join(str(book.id) for book in catalog)
+    assert APIClient().get(f"/api/books?ids={ids}").status_code == 200
+    # The version and modified stamps of every book, then the rows.
+    assert writes == [("set_many", 2 * len(catalog)), ("set_many", len(catalog))]
+
+
+@pytest.mark.django_db
+def test_books_bulk_patch(locmem_cache, rest_client, catalog, monkeypatch):
+    from api import views
+
+    invalidated = []
+    monkeypatch.setattr(views, "invalidate_books", lambda *ids: invalidated.append(ids))
+    changes = [
+        {"id": catalog[0].id, "price": 100, "quantity": 7},
+        {"id": catalog[1].id, "author": "New  Author", "title": "Renamed"},
+        {"id": catalog[2].id, "publication_date": "2020-01-02"},
+    ]
+    with CaptureQueriesContext(connection) as queries:
+        response = rest_client.patch("/api/books/bulk", changes, format="json")
+    assert response.status_code == 200
+    assert response.json()["updated"] == 3
+    updates = [q for q in queries.captured_queries if q["sql"].startswith("UPDATE")]
+    assert len(updates) == 1 and "CASE" in updates[0]["sql"]
+    assert invalidated == [tuple(change["id"] for change in changes)]
+
+    books = Book.objects.select_related("author").in_bulk(
+        [change["id"] for change in changes]
+    )
+    assert (books[catalog[0].id].price, books[catalog[0].id].quantity) == (100, 7)
+    assert books[catalog[1].id].title == "Renamed"
+    assert books[catalog[1].id].author.name == "New Author"
+    assert books[catalog[1].id].updated_at > catalog[1].updated_at
+    assert books[catalog[2].id].publication_date == date(2020, 1, 2)
+    assert books[catalog[2].id].price == catalog[2].price
+
+    before = list(Book.objects.order_by("id").values())
+    for batch, code in (
+        ([{"id": catalog[0].id, "price": 5}, {"id": 0, "price": 5}], 404),
+        ([{"id": catalog[0].id, "price": -1}], 400),
+        ([{"id": catalog[0].id, "isbn": "x"}], 400),
+        ([{"id": catalog[0].id}, {"id": catalog[0].id}], 400),
+        ([{"price": 5}], 400),
+        ([], 400),
+        ({"id": catalog[0].id}, 400),
+    ):
+        response = rest_client.patch("/api/books/bulk", batch, format="json")
+        assert response.status_code == code, batch
+    assert response.status_code == 400
+    assert list(Book.objects.order_by("id").values()) == before
+    assert len(invalidated) == 1
+
+    response = APIClient().patch("/api/books/bulk", changes, format="json")
+    assert response.status_code in (401, 403)
+
+
+def test_invalidate_books_writes_book_stamps_at_once(locmem_cache, monkeypatch):
+    book = BOOK.format(id=1)
+    (_, before), _ = get_stamps([BOOKS, book])
+    writes = spy_cache_writes(locmem_cache, monkeypatch, ("add", "incr", "set_many"))
+
+    invalidate_books(*range(1, 501))
+
+    # Only the collection stamp is incremented; 500 versions and 501 modified.
+    key = VERSION_KEY.format(BOOKS)
+    assert writes == [("add", key), ("incr", key), ("set_many", 1001)]
+    local_cache.clear()
+    (_, after), _ = get_stamps([BOOKS, book])
+    assert after != before